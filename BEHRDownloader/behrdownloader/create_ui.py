@@ -3,16 +3,157 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 from collections import OrderedDict
+import datetime as dt
+import os
+import threading
+import time
 
 from . import download_behr as getbehr
 
+# The DASH interface only works in Python 3; without it the GUI can still list files
+try:
+    from . import dash_interface
+    from .manifest import DashManifest, member_selection
+except (SyntaxError, ImportError):
+    dash_interface = None
+
 __metaclass__ = type  # Automatically makes Python 2 classes inherit from object to be new-style classes
 
 
 try:
     import Tkinter as tk
+    import tkFileDialog as filedialog
+    import ttk
+    import Queue as queue
 except ImportError:
     import tkinter as tk
+    from tkinter import filedialog
+    from tkinter import ttk
+    import queue
+
+# How often the GUI checks for messages from the background worker, in milliseconds
+poll_interval_ms = 100
+# How often a download reports its progress to the GUI, in seconds
+progress_interval_s = 0.25
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class BackgroundWorker():
+    """
+    Runs jobs one at a time on a background thread, so that slow network calls do not freeze the GUI.
+
+    Tk widgets may only be touched from the main thread, so jobs never update the GUI themselves. Instead they call
+    :meth:`post` to put messages on :attr:`messages`, which the GUI reads on a timer with ``root.after``.
+
+    Each job is a function called with the worker as its first argument, followed by the arguments given to
+    :meth:`submit`. A long job should check :attr:`cancel_event` now and then and raise :class:`JobCancelled` if it
+    is set.
+    """
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.messages = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, name, fxn, *args, **kwargs):
+        self.jobs.put((name, fxn, args, kwargs))
+
+    def post(self, kind, *args):
+        self.messages.put((kind,) + args)
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def _run(self):
+        while True:
+            name, fxn, args, kwargs = self.jobs.get()
+            self.cancel_event.clear()
+            self.post('started', name)
+            try:
+                result = fxn(self, *args, **kwargs)
+            except JobCancelled:
+                self.post('cancelled', name)
+            except Exception as err:
+                self.post('error', name, err)
+            else:
+                self.post('finished', name, result)
+
+
+def list_job(worker, region, profile_mode, start_date, end_date, check_exists):
+    worker.post('status', 'Listing files...')
+    if check_exists:
+        files = [f for f, url in getbehr.iter_existing_files(region, profile_mode, start_date, end_date)]
+    else:
+        files = list(getbehr.iter_file_list(region, profile_mode, start_date, end_date))
+    worker.post('files', files, 0)
+    return '{} files'.format(len(files))
+
+
+def download_job(worker, dataset, start, end, out_dir, extract_tar):
+    # Downloads the archives one at a time so that each one's status can be shown, skipping any already recorded in
+    # the download directory's manifest, like the "sync" action of dash_interface.
+    worker.post('status', 'Listing files on DASH...')
+    file_info = dash_interface.get_dash_file_info_from_doi(dash_interface.behr_dois[dataset])
+    files = list(dash_interface.iter_files_for_dates(dash_interface.file_urls(file_info), start, end))
+    manifest = DashManifest(out_dir, file_info, logging_fxn=lambda msg: worker.post('status', msg))
+    worker.post('files', [f for f, url in files], sum(file_info[f]['size'] or 0 for f, url in files))
+
+    # The bytes of the files finished so far. The progress of the file being downloaded is the size of its .part file
+    # rather than a count of the blocks received, since that includes what an earlier, interrupted run downloaded and
+    # goes back to zero if the download has to start over.
+    progress = {'bytes': 0, 'posted': 0.0, 'part_name': None}
+
+    def current_progress():
+        part_name = progress['part_name']
+        if part_name is not None and os.path.isfile(part_name):
+            return progress['bytes'] + os.path.getsize(part_name)
+        return progress['bytes']
+
+    def update_progress(n_bytes):
+        if worker.cancel_event.is_set():
+            raise JobCancelled()
+        now = time.time()
+        if now - progress['posted'] >= progress_interval_s:
+            worker.post('progress', current_progress())
+            progress['posted'] = now
+
+    n_failed = 0
+    for fname, url in files:
+        if worker.cancel_event.is_set():
+            raise JobCancelled()
+        if manifest.is_current(fname, selection=member_selection() if extract_tar else None):
+            worker.post('file', fname, 'already downloaded')
+            progress['bytes'] += file_info[fname]['size'] or 0
+            update_progress(0)
+            continue
+
+        worker.post('file', fname, 'downloading')
+        progress['part_name'] = os.path.join(out_dir, fname + '.part')
+        try:
+            dash_interface.download_and_extract_one(fname, url, out_dir=out_dir, extract_tar=extract_tar,
+                                                    expected=file_info[fname], block_size=2**16,
+                                                    progress_fxn=update_progress, manifest=manifest,
+                                                    logging_fxn=lambda msg: worker.post('status', msg))
+        except JobCancelled:
+            worker.post('file', fname, 'cancelled, will resume next time')
+            raise
+        except Exception as err:
+            n_failed += 1
+            worker.post('file', fname, 'failed: {}'.format(err))
+        else:
+            progress['bytes'] += file_info[fname]['size'] or 0
+            worker.post('file', fname, 'done')
+        finally:
+            progress['part_name'] = None
+
+    worker.post('progress', progress['bytes'])
+    return '{} of {} files downloaded or already present'.format(len(files) - n_failed, len(files))
+
 
 class GetBEHRGuiMain():
     def __init__(self, root_window):
@@ -30,18 +171,25 @@ class GetBEHRGuiDownload():
     # BEHR file names and the file hierarchy
     regions_dict = OrderedDict([('United States', 'US'), ('Hong Kong', 'HK')])
     prof_modes_list = ['Monthly', 'Daily']
+    # The keys are the names listed in the options menu, the values the part of the dash_interface dataset name after
+    # the profile mode
+    products_dict = OrderedDict([('Native pixels', 'native'), ('Gridded', 'gridded')])
 
     def __init__(self, main_instance):
         self.main = main_instance
         self.root_window = main_instance.root_window
+        self.worker = BackgroundWorker()
+        self.file_rows = dict()
         self._create_selectors()
+        self._create_download_widgets()
+        self.root_window.after(poll_interval_ms, self._poll_worker)
 
     def _create_selectors(self):
         self.region_label = tk.Label(self.root_window, text="Region")
         self.region_label.pack()
 
         self.region = tk.StringVar(self.root_window)
-        self.region.set(self.regions_dict.keys()[0])
+        self.region.set(list(self.regions_dict.keys())[0])
         self.region_dropdown = tk.OptionMenu(self.root_window, self.region, *self.regions_dict.keys())
         self.region_dropdown.pack()
 
@@ -69,13 +217,127 @@ class GetBEHRGuiDownload():
         self.enddate.set('2016-12-31')
         self.enddate_input.pack()
 
+        self.check_exists = tk.BooleanVar(self.root_window)
+        self.check_exists_box = tk.Checkbutton(self.root_window, text='Only list files that exist',
+                                               variable=self.check_exists)
+        self.check_exists_box.pack()
+
         self.list_button = tk.Button(self.root_window, text='List files', command=self.db_print_files)
         self.list_button.pack()
 
+    def _create_download_widgets(self):
+        self.product_label = tk.Label(self.root_window, text="Product (DASH download)")
+        self.product_label.pack()
+
+        self.product = tk.StringVar(self.root_window)
+        self.product.set(list(self.products_dict.keys())[0])
+        self.product_dropdown = tk.OptionMenu(self.root_window, self.product, *self.products_dict.keys())
+        self.product_dropdown.pack()
+
+        self.outdir_label = tk.Label(self.root_window, text="Download directory")
+        self.outdir_label.pack()
+
+        self.outdir = tk.StringVar(self.root_window)
+        self.outdir.set(os.getcwd())
+        self.outdir_input = tk.Entry(self.root_window, textvariable=self.outdir, width=40)
+        self.outdir_input.pack()
+        self.outdir_button = tk.Button(self.root_window, text='Choose...', command=self.choose_outdir)
+        self.outdir_button.pack()
+
+        self.extract_tar = tk.BooleanVar(self.root_window)
+        self.extract_tar_box = tk.Checkbutton(self.root_window, text='Extract .hdf files', variable=self.extract_tar)
+        self.extract_tar_box.pack()
+
+        self.download_button = tk.Button(self.root_window, text='Download', command=self.download_files)
+        if dash_interface is None:
+            self.download_button.config(state=tk.DISABLED, text='Download (requires Python 3)')
+        self.download_button.pack()
+
+        self.cancel_button = tk.Button(self.root_window, text='Cancel', command=self.worker.cancel, state=tk.DISABLED)
+        self.cancel_button.pack()
+
+        self.progress = ttk.Progressbar(self.root_window, orient=tk.HORIZONTAL, length=300, mode='determinate')
+        self.progress.pack()
+
+        self.status = tk.StringVar(self.root_window)
+        self.status_label = tk.Label(self.root_window, textvariable=self.status)
+        self.status_label.pack()
+
+        self.file_list = tk.Listbox(self.root_window, width=80, height=12)
+        self.file_list.pack()
+
+    def choose_outdir(self):
+        outdir = filedialog.askdirectory(initialdir=self.outdir.get())
+        if outdir:
+            self.outdir.set(outdir)
+
     def db_print_files(self):
         region = self.region.get()
         region_abbr = self.regions_dict[region]
-        getbehr.print_file_list_debug(region_abbr, self.profmode.get(), self.startdate.get(), self.enddate.get())
+        self.worker.submit('List', list_job, region_abbr, self.profmode.get(), self.startdate.get(),
+                           self.enddate.get(), self.check_exists.get())
+
+    def download_files(self):
+        try:
+            start = dt.datetime.strptime(self.startdate.get(), '%Y-%m-%d')
+            end = dt.datetime.strptime(self.enddate.get(), '%Y-%m-%d')
+        except ValueError:
+            self.status.set('Dates must be given as yyyy-mm-dd')
+            return
+        if not os.path.isdir(self.outdir.get()):
+            self.status.set('{} is not a directory'.format(self.outdir.get()))
+            return
+
+        dataset = '{}-{}'.format(self.profmode.get().lower(), self.products_dict[self.product.get()])
+        self.worker.submit('Download', download_job, dataset, start, end, self.outdir.get(), self.extract_tar.get())
+
+    def _set_busy(self, busy):
+        state = tk.DISABLED if busy else tk.NORMAL
+        self.list_button.config(state=state)
+        if dash_interface is not None:
+            self.download_button.config(state=state)
+        self.cancel_button.config(state=tk.NORMAL if busy else tk.DISABLED)
+
+    def _set_file_status(self, fname, status):
+        row = self.file_rows[fname]
+        self.file_list.delete(row)
+        self.file_list.insert(row, '{}: {}'.format(fname, status) if status else fname)
+        self.file_list.see(row)
+
+    def _poll_worker(self):
+        # Apply everything the worker has posted since the last check, then check again later
+        try:
+            while True:
+                message = self.worker.messages.get_nowait()
+                kind, args = message[0], message[1:]
+                if kind == 'started':
+                    self._set_busy(True)
+                    self.status.set('{}...'.format(args[0]))
+                elif kind == 'status':
+                    self.status.set(args[0])
+                elif kind == 'files':
+                    files, total_bytes = args
+                    self.file_list.delete(0, tk.END)
+                    self.file_rows = dict((f, i) for i, f in enumerate(files))
+                    for f in files:
+                        self.file_list.insert(tk.END, f)
+                    self.progress.config(maximum=max(total_bytes, 1), value=0)
+                elif kind == 'file':
+                    self._set_file_status(*args)
+                elif kind == 'progress':
+                    self.progress.config(value=min(args[0], self.progress.cget('maximum')))
+                elif kind == 'finished':
+                    self._set_busy(False)
+                    self.status.set('{} finished: {}'.format(*args))
+                elif kind == 'cancelled':
+                    self._set_busy(False)
+                    self.status.set('{} cancelled'.format(args[0]))
+                elif kind == 'error':
+                    self._set_busy(False)
+                    self.status.set('{} failed: {}'.format(*args))
+        except queue.Empty:
+            pass
+        self.root_window.after(poll_interval_ms, self._poll_worker)
 
 if __name__ == '__main__':
     root = tk.Tk()
@@ -84,4 +346,4 @@ if __name__ == '__main__':
     root.lift()
     root.attributes('-topmost', True)
     root.after_idle(root.attributes, '-topmost', False)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
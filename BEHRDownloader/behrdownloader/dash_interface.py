@@ -1,11 +1,24 @@
 #!/usr/bin/env python
 from __future__ import print_function
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import datetime as dt
+import fnmatch
+import hashlib
+import json
 import os
+import queue
+import re
 import requests
+import shlex
+import subprocess
 import tarfile
+import threading
+import time
 
+from . import dash_session
+from . import metrics
+from .manifest import DashManifest, member_selection
 from .utils import smart_open
 
 import pdb
@@ -13,6 +26,13 @@ import pdb
 dash_root = "https://dash.ucop.edu"
 request_params = {"accept": "application/json"}
 default_block_size_bytes = 4096
+default_cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')),
+                                 'behrdownloader')
+default_cache_ttl_s = 24 * 3600
+# The orders download_and_extract can fetch months in: oldest first or newest first
+file_orders = ('date', 'newest')
+# How many items may wait between two stages of the download pipeline before the earlier stage waits for the later one
+default_queue_size = 2
 
 behr_dois = {'daily-gridded': 'doi:10.6078/D12D5X',
              'monthly-gridded': 'doi:10.6078/D1RQ3G',
@@ -26,6 +46,25 @@ to download files from the above BEHR repositories.
 """
 
 
+class IntegrityError(IOError):
+    """
+    Error raised when a downloaded file does not have the size or checksum that DASH reports for it.
+    """
+    pass
+
+
+class TruncatedDownloadError(IntegrityError):
+    """
+    Error raised when the server closes a download before sending the number of bytes it said it would. This is
+    treated like a dropped connection, i.e. the download is resumed.
+    """
+    pass
+
+
+_transient_errors = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                     requests.exceptions.Timeout, TruncatedDownloadError)
+
+
 def replace_ascii_html(s):
     """
     Replace certain ASCII characters with their HTML code equivalent
@@ -45,23 +84,115 @@ def replace_ascii_html(s):
     return s
 
 
-def get_dash_files_from_doi(doi):
+def _listing_cache_file(doi, cache_dir):
+    return os.path.join(cache_dir, 'dash_listing_{}.json'.format(replace_ascii_html(doi)))
+
+
+def read_listing_cache(doi, cache_dir=default_cache_dir):
     """
-    Create a dictionary linking file names to URLs for the dataset pointed to by a DOI.
+    Read the cached DASH file listing for a DOI.
 
     :param doi: the DOI as a string starting with "doi:"
     :type doi: str
 
-    :return: a dictionary with file names as the keys and URLs as the values.
+    :param cache_dir: optional, the directory the listing cache is kept in.
+    :type cache_dir: str
+
+    :return: the cached listing, a dictionary with the keys "dash_root", "version", "fetched" (the Unix time the
+        listing was last checked against DASH) and "files" (as returned by :func:`get_dash_file_info_from_doi`), or
+        ``None`` if there is no usable cached listing.
+    """
+    cache_file = _listing_cache_file(doi, cache_dir)
+    if not os.path.isfile(cache_file):
+        return None
+
+    try:
+        with open(cache_file) as fobj:
+            cache = json.load(fobj)
+    except ValueError:
+        # A corrupted cache is not worth failing over, we will just list the files again
+        return None
+
+    if cache.get('dash_root') != dash_root:
+        return None
+    return cache
+
+
+def write_listing_cache(doi, version, file_info, cache_dir=default_cache_dir):
+    """
+    Save a DASH file listing for a DOI to the cache.
+
+    :param doi: the DOI as a string starting with "doi:"
+    :type doi: str
+
+    :param version: the DASH version number of the dataset that was listed
+    :type version: int
+
+    :param file_info: the listing, as returned by :func:`get_dash_file_info_from_doi`
+    :type file_info: dict
+
+    :param cache_dir: optional, the directory the listing cache is kept in. It will be created if needed.
+    :type cache_dir: str
+
+    :return: None
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    cache_file = _listing_cache_file(doi, cache_dir)
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as fobj:
+        json.dump({'dash_root': dash_root, 'version': version, 'fetched': time.time(), 'files': file_info}, fobj)
+    os.replace(tmp_file, cache_file)
+
+
+def get_dash_file_info_from_doi(doi, refresh=False, cache_ttl=default_cache_ttl_s, cache_dir=default_cache_dir):
+    """
+    Create a dictionary linking file names to their URLs and metadata for the dataset pointed to by a DOI.
+
+    Listing a dataset requires one request per 10 files, so the listing is cached on disk for each DOI along with
+    the dataset version it describes. A cached listing less than ``cache_ttl`` seconds old is used without contacting
+    DASH at all. An older one is used as long as DASH reports that the newest version of the dataset is still the one
+    that was cached, which only costs a single request.
+
+    :param doi: the DOI as a string starting with "doi:"
+    :type doi: str
+
+    :param refresh: optional, set to ``True`` to ignore any cached listing and list the dataset from DASH again.
+        Default is ``False``.
+    :type refresh: bool
+
+    :param cache_ttl: optional, how long in seconds a cached listing is trusted without checking the dataset version.
+        Default is one day.
+    :type cache_ttl: int or float
+
+    :param cache_dir: optional, the directory to keep the listing cache in. Default is "behrdownloader" in the user's
+        cache directory (``$XDG_CACHE_HOME`` or ``~/.cache``). Pass ``None`` to disable the cache.
+    :type cache_dir: str or None
+
+    :return: a dictionary with file names as the keys. Each value is a dictionary with the keys "url" (the download
+        URL), "size" (in bytes), "digest" and "digest_type" (the checksum DASH reports for the file) and "version" (the
+        DASH version number of the dataset). Metadata DASH does not report is ``None``.
     """
-    doi = replace_ascii_html(doi)
+    cache = None
+    if cache_dir is not None and not refresh:
+        cache = read_listing_cache(doi, cache_dir=cache_dir)
+        if cache is not None and time.time() - cache['fetched'] < cache_ttl:
+            return cache['files']
+
     # First, we get a list of all versions associated with this DOI
-    versions = requests.get("{}/api/datasets/{}/versions".format(dash_root, doi), params=request_params)
+    t0 = time.time()
+    session = dash_session.get_session()
+    versions = session.get("{}/api/datasets/{}/versions".format(dash_root, replace_ascii_html(doi)),
+                           params=request_params)
+    versions.raise_for_status()
+    versions_bytes = versions.content
+    versions = versions.json()['_embedded']['stash:versions']
 
     # Find the most recent version
     newest_version = -1
     newest_idx = -1
-    for idx, a_version in enumerate(versions.json()['_embedded']['stash:versions']):
+    for idx, a_version in enumerate(versions):
         if a_version['versionNumber'] > newest_version:
             newest_version = a_version['versionNumber']
             newest_idx = idx
@@ -69,20 +200,33 @@ def get_dash_files_from_doi(doi):
     if newest_idx < 0:
         raise RuntimeError('Failed to find the newest version')
 
+    if cache is not None and cache['version'] == newest_version:
+        # The dataset hasn't changed since we last listed it, so just mark the listing as checked
+        write_listing_cache(doi, newest_version, cache['files'], cache_dir=cache_dir)
+        metrics.add('listing', time.time() - t0, bytes=len(versions_bytes))
+        return cache['files']
 
-    # Assuming that the list of versions is in chronological order, we want the most recent one
-    # In that version get the URL to request the first page of files
-    file_url = versions.json()['_embedded']['stash:versions'][newest_idx]['_links']['stash:files']['href']
+    # In the most recent version get the URL to request the first page of files
+    file_url = versions[newest_idx]['_links']['stash:files']['href']
 
     file_dict = dict()
+    n_bytes = len(versions_bytes)
 
     while True:
-        file_group = requests.get("{}{}".format(dash_root, file_url), params=request_params).json()
+        file_group = session.get("{}{}".format(dash_root, file_url), params=request_params)
+        file_group.raise_for_status()
+        n_bytes += len(file_group.content)
+        file_group = file_group.json()
         # Now we can retrieve a list of the available files
         file_list = file_group['_embedded']['stash:files']
 
-        # Extract the file name and link into a more easily comprehendable dict
-        file_dict.update({f['path']: dash_root + f['_links']['stash:download']['href'] for f in file_list})
+        # Extract the file name, link, and metadata into a more easily comprehendable dict
+        file_dict.update({f['path']: {'url': dash_root + f['_links']['stash:download']['href'],
+                                      'size': f.get('size'),
+                                      'digest': f.get('digest'),
+                                      'digest_type': f.get('digestType'),
+                                      'version': newest_version}
+                          for f in file_list})
 
         # The files aren't all returned at once - 10 are listed per "page" so as long as there is a next page, we need
         # to get the files listed on that page and add them to the dictionary
@@ -91,13 +235,136 @@ def get_dash_files_from_doi(doi):
         else:
             break
 
+    metrics.add('listing', time.time() - t0, bytes=n_bytes, files=len(file_dict))
+    if cache_dir is not None:
+        write_listing_cache(doi, newest_version, file_dict, cache_dir=cache_dir)
+
     return file_dict
 
 
-def download_file(url, out_name, block_size=default_block_size_bytes):
+def get_dash_files_from_doi(doi, **kwargs):
+    """
+    Create a dictionary linking file names to URLs for the dataset pointed to by a DOI.
+
+    :param doi: the DOI as a string starting with "doi:"
+    :type doi: str
+
+    :param kwargs: additional keyword arguments controlling the listing cache are passed through to
+        :func:`get_dash_file_info_from_doi`.
+
+    :return: a dictionary with file names as the keys and URLs as the values.
+    """
+    return file_urls(get_dash_file_info_from_doi(doi, **kwargs))
+
+
+def file_urls(file_info):
+    """
+    Reduce the dictionary returned by :func:`get_dash_file_info_from_doi` to one mapping file names to URLs.
+
+    :param file_info: the dictionary of file names to metadata
+    :type file_info: dict
+
+    :return: a dictionary with file names as the keys and URLs as the values.
+    """
+    return {fname: info['url'] for fname, info in file_info.items()}
+
+
+def new_hash(digest_type):
+    """
+    Create a :mod:`hashlib` hash object for a digest type as named by DASH, e.g. "md5" or "sha-256".
+
+    :param digest_type: the digest type
+    :type digest_type: str or None
+
+    :return: the hash object, or ``None`` if ``digest_type`` is ``None`` or not supported by :mod:`hashlib`.
+    """
+    if digest_type is None:
+        return None
+    name = digest_type.lower().replace('-', '')
+    if name not in hashlib.algorithms_available:
+        return None
+    return hashlib.new(name)
+
+
+def file_digest(filename, digest_type, block_size=2**20):
+    """
+    Compute the checksum of a file on disk.
+
+    :param filename: the file to compute the checksum of
+    :type filename: str
+
+    :param digest_type: the digest type, as named by DASH
+    :type digest_type: str
+
+    :param block_size: optional, how many bytes to read at once. Default is 1 MiB.
+    :type block_size: int
+
+    :return: the hexadecimal digest, or ``None`` if ``digest_type`` is not supported
+    :rtype: str or None
+    """
+    hasher = new_hash(digest_type)
+    if hasher is None:
+        return None
+    with open(filename, 'rb') as fobj:
+        for block in iter(lambda: fobj.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def check_integrity(name, size, digest, expected):
+    """
+    Compare the size and checksum of a file against those DASH reports for it.
+
+    :param name: the name of the file, used in the error message
+    :type name: str
+
+    :param size: the size of the file in bytes
+    :type size: int
+
+    :param digest: the hexadecimal checksum of the file, or ``None`` if not computed
+    :type digest: str or None
+
+    :param expected: the DASH metadata for the file, as in the values of the dictionary returned by
+        :func:`get_dash_file_info_from_doi`. A size or digest of ``None`` is not checked.
+    :type expected: dict
+
+    :return: None
+    :raises IntegrityError: if the size or checksum does not match.
+    """
+    if expected.get('size') is not None and size != expected['size']:
+        raise IntegrityError('{} is {} bytes, expected {}'.format(name, size, expected['size']))
+    if expected.get('digest') is not None and digest is not None and digest.lower() != expected['digest'].lower():
+        raise IntegrityError('{} has {} checksum {}, expected {}'.format(
+            name, expected['digest_type'], digest, expected['digest']
+        ))
+
+
+def _check_content_length(response, n_received):
+    # If the response was compressed in transit, the decoded bytes won't match Content-Length, so skip the check
+    content_length = response.headers.get('Content-Length')
+    if content_length is None or 'Content-Encoding' in response.headers:
+        return
+    if n_received < int(content_length):
+        raise TruncatedDownloadError('Received {} of {} bytes from {}'.format(n_received, content_length, response.url))
+
+
+def download_file(url, out_name, block_size=default_block_size_bytes, resume=True, expected=None, progress_fxn=None):
     """
     Download a file from the given URL.
 
+    The data is written to ``out_name + ".part"`` and only renamed to ``out_name`` once the whole file has been
+    received, so an interrupted download never leaves a truncated file under the final name. If a ``.part`` file is
+    already present, the download picks up where it left off with an HTTP Range request. If the server ignores the
+    Range header and sends the whole file, the partial file is discarded and the download starts over.
+
+    Requests go through the shared session from :mod:`behrdownloader.dash_session`, which retries failed connections
+    and transient HTTP errors. If the connection drops part way through the file, the download is resumed from the
+    ``.part`` file, up to the session's number of retries.
+
+    The number of bytes received is checked against the Content-Length of each response. If ``expected`` is given, the
+    checksum is computed as the file is written and the finished file is checked against the DASH size and checksum.
+    A file that fails this check is deleted.
+
     :param url: the URL to download
     :type url: str
 
@@ -108,18 +375,335 @@ def download_file(url, out_name, block_size=default_block_size_bytes):
         downloaded. Optional, default is 4096
     :type block_size: int
 
+    :param resume: optional, whether to continue from an existing ``.part`` file. Default is ``True``; if ``False``
+        any partial file is overwritten.
+    :type resume: bool
+
+    :param expected: optional, the DASH metadata for the file, as in the values of the dictionary returned by
+        :func:`get_dash_file_info_from_doi`. Default is ``None``, i.e. only check the Content-Length.
+    :type expected: dict or None
+
+    :param progress_fxn: optional, a function called with the number of bytes in each block as it is received. An
+        exception raised by it stops the download, leaving the ``.part`` file to resume from later. Default is
+        ``None``.
+    :type progress_fxn: function or None
+
+    :return: the number of bytes transferred by this call (not counting any previously downloaded part)
+    :rtype: int
+    :raises IntegrityError: if the downloaded file does not match ``expected``.
+    """
+    session = dash_session.get_session()
+    part_name = out_name + '.part'
+    digest_type = expected.get('digest_type') if expected is not None else None
+    hasher = None
+    n_bytes = 0
+    attempt = 0
+    while True:
+        offset = os.path.getsize(part_name) if resume and os.path.isfile(part_name) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else dict()
+
+        dl_obj = None
+        try:
+            # Requesting the URL as a stream will not try to download the entire file at once
+            dl_obj = session.get(url, stream=True, headers=headers)
+            if dl_obj.status_code == 416 and dl_obj.headers.get('Content-Range', '') == 'bytes */{}'.format(offset):
+                # The part file already holds the whole file, we were just interrupted before renaming it
+                break
+            elif dl_obj.status_code == 416 and offset > 0:
+                # The part file doesn't fit the file on the server (e.g. it is left over from an older, larger
+                # version), so it can't be resumed; start again from the beginning
+                os.remove(part_name)
+                continue
+
+            dl_obj.raise_for_status()
+            hasher = new_hash(digest_type)
+            if dl_obj.status_code == 206:
+                mode = 'ab'
+                if hasher is not None:
+                    # Only the part we already have needs reading back, the rest is hashed as it arrives
+                    with open(part_name, 'rb') as partfile:
+                        for block in iter(lambda: partfile.read(2**20), b''):
+                            hasher.update(block)
+            else:
+                # The server sent the whole file (either we didn't ask for a range or it ignored the request)
+                mode = 'wb'
+
+            n_received = 0
+            with open(part_name, mode) as outfile:
+                for block in dl_obj.iter_content(block_size):
+                    outfile.write(block)
+                    if hasher is not None:
+                        hasher.update(block)
+                    n_received += len(block)
+                    if progress_fxn is not None:
+                        progress_fxn(len(block))
+                    session.throttle(len(block))
+            n_bytes += n_received
+            _check_content_length(dl_obj, n_received)
+            break
+        except _transient_errors:
+            attempt += 1
+            if not resume or attempt > session.retries:
+                raise
+            time.sleep(session.backoff_time(attempt))
+        finally:
+            # Return the connection to the pool even if the download was abandoned part way, otherwise a session
+            # with max_per_host could run out of connections
+            if dl_obj is not None:
+                dl_obj.close()
+
+    if expected is not None:
+        digest = hasher.hexdigest() if hasher is not None else file_digest(part_name, digest_type)
+        try:
+            check_integrity(out_name, os.path.getsize(part_name), digest, expected)
+        except IntegrityError:
+            os.remove(part_name)
+            raise
+
+    os.replace(part_name, out_name)
+    return n_bytes
+
+
+def is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+
+    prefix = os.path.commonprefix([abs_directory, abs_target])
+
+    return prefix == abs_directory
+
+
+def check_member_path(member, path):
+    """
+    Raise an exception if a tar archive member would be extracted outside of the given directory.
+
+    :param member: the archive member
+    :type member: tarfile.TarInfo
+
+    :param path: the directory the archive is being extracted into
+    :type path: str
+
     :return: None
     """
-    # Requesting the URL as a stream will not try to download the entire file at once
-    dl_obj = requests.get(url, stream=True)
-    dl_obj.raise_for_status()
+    member_path = os.path.join(path, member.name)
+    if not is_within_directory(path, member_path):
+        raise Exception("Attempted Path Traversal in Tar File")
+
+
+def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
+    for member in tar.getmembers():
+        check_member_path(member, path)
+
+    tar.extractall(path, members, numeric_owner=numeric_owner)
+
+
+def make_member_selector(days=None, member_glob=None):
+    """
+    Create a function that decides whether a member of a BEHR archive should be extracted.
+
+    :param days: optional, the days of the month to extract. Members are matched on the yyyymmdd date in their file
+        name; members without such a date are never selected if this is given. Default is ``None``, i.e. any day.
+    :type days: collection of int or None
+
+    :param member_glob: optional, a shell-style pattern (e.g. ``"*_US_*.hdf"``) the base name of the member must match.
+        Default is ``None``, i.e. any name.
+    :type member_glob: str or None
+
+    :return: a function that takes a member name and returns ``True`` if it should be extracted, or ``None`` if there
+        is no filtering to do.
+    """
+    if days is None and member_glob is None:
+        return None
 
-    with open(out_name, 'wb') as outfile:
-        for block in dl_obj.iter_content(block_size):
-            outfile.write(block)
+    def select(member_name):
+        basename = os.path.basename(member_name)
+        if member_glob is not None and not fnmatch.fnmatch(basename, member_glob):
+            return False
+        if days is not None:
+            match = re.search(r'\d{8}', basename)
+            if match is None or int(match.group()[6:]) not in days:
+                return False
+        return True
 
+    return select
 
-def extract_tar_file(filename, delete_tar=False, verbose=0, logging_fxn=print):
+
+class _ResponseReader():
+    """
+    File-like wrapper around a streamed HTTP response that :mod:`tarfile` can read from in stream mode, optionally
+    copying every byte read to a second file, updating a checksum and reporting progress as it goes. ``throttle_fxn``
+    is called with the size of each block received, e.g. :meth:`~behrdownloader.dash_session.DashSession.throttle`.
+    """
+    def __init__(self, response, block_size=default_block_size_bytes, copy_to=None, hasher=None, progress_fxn=None,
+                 throttle_fxn=None):
+        self._blocks = response.iter_content(block_size)
+        # A bytearray so that taking data off the front does not copy everything left behind it, which would make large
+        # blocks slow to read in tarfile's small pieces
+        self._buffer = bytearray()
+        self._copy_to = copy_to
+        self._progress_fxn = progress_fxn
+        self._throttle_fxn = throttle_fxn
+        self.hasher = hasher
+        self.n_bytes = 0
+        # True once the response has no more data, whether or not all of it arrived
+        self.eof = False
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                block = next(self._blocks)
+            except StopIteration:
+                self.eof = True
+                break
+            self.n_bytes += len(block)
+            if self._copy_to is not None:
+                self._copy_to.write(block)
+            if self.hasher is not None:
+                self.hasher.update(block)
+            if self._progress_fxn is not None:
+                self._progress_fxn(len(block))
+            if self._throttle_fxn is not None:
+                self._throttle_fxn(len(block))
+            self._buffer += block
+
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+
+def _remove_members(extract_path, members):
+    # Remove files extracted from an archive that turned out to be incomplete or corrupt
+    for m in members:
+        try:
+            os.remove(os.path.join(extract_path, m))
+        except OSError:
+            pass
+
+
+def stream_extract_file(url, out_name, keep_tar=True, select=None, expected=None, block_size=default_block_size_bytes, progress_fxn=None, verbose=0, logging_fxn=print):
+    """
+    Download a gzipped tar archive and extract its members as they arrive, without reading the archive back from disk.
+
+    Members are extracted into the directory containing ``out_name``, subject to the same path traversal check as
+    :func:`extract_tar_file`. Because a gzip stream cannot be picked up part way through, a dropped connection restarts
+    the whole archive (up to the shared session's number of retries) rather than resuming it. The checksum is computed
+    from the same stream, so the archive is verified against ``expected`` without being read twice.
+
+    :param url: the URL to download
+    :type url: str
+
+    :param out_name: the name to give the archive, if it is kept. Its directory is where the members are extracted.
+    :type out_name: str
+
+    :param keep_tar: optional, whether to also save the archive itself to ``out_name``. If ``False``, the archive is
+        never written to disk. Default is ``True``.
+    :type keep_tar: bool
+
+    :param select: optional, a function that takes a member name and returns ``True`` if it should be extracted, such
+        as one created by :func:`make_member_selector`. Other members are skipped over in the stream without being
+        written. Default is ``None``, i.e. extract everything.
+    :type select: function or None
+
+    :param expected: optional, the DASH metadata for the archive, as in the values of the dictionary returned by
+        :func:`get_dash_file_info_from_doi`. Default is ``None``, i.e. only check the Content-Length.
+    :type expected: dict or None
+
+    :param block_size: the size in bytes to download at once. Optional, default is 4096
+    :type block_size: int
+
+    :param progress_fxn: optional, a function called with the number of bytes in each block as it is received. An
+        exception raised by it stops the download. Default is ``None``.
+    :type progress_fxn: function or None
+
+    :param verbose: Controls the logging verbosity. Default is 0
+    :type verbose: int
+
+    :param logging_fxn: optional, the function to call to print logging messages. Default is ``print``
+    :type logging_fxn: function
+
+    :return: the number of bytes downloaded and the names of the files extracted, relative to the extraction directory
+    :rtype: int, list of str
+    :raises IntegrityError: if the archive does not match ``expected``. The files extracted from it are removed.
+    """
+    session = dash_session.get_session()
+    digest_type = expected.get('digest_type') if expected is not None else None
+    extract_path = os.path.dirname(out_name)
+    part_name = out_name + '.part'
+    n_bytes = 0
+    attempt = 0
+    while True:
+        members = []
+        tar_copy = open(part_name, 'wb') if keep_tar else None
+        dl_obj = None
+        finished = False
+        try:
+            dl_obj = session.get(url, stream=True)
+            dl_obj.raise_for_status()
+            reader = _ResponseReader(dl_obj, block_size=block_size, copy_to=tar_copy, hasher=new_hash(digest_type),
+                                     progress_fxn=progress_fxn, throttle_fxn=session.throttle)
+            try:
+                with tarfile.open(fileobj=reader, mode='r|gz') as tarobj:
+                    for member in tarobj:
+                        check_member_path(member, extract_path)
+                        if select is not None and not select(member.name):
+                            continue
+                        if verbose > 1:
+                            logging_fxn('Extracting {}'.format(member.name))
+                        # Recorded before extracting so that a member cut off part way through is cleaned up too
+                        if member.isfile():
+                            members.append(member.name)
+                        tarobj.extract(member, extract_path)
+                # tarfile stops at the end-of-archive marker, make sure the copy of the archive and the checksum get any
+                # padding after it
+                reader.read()
+            except (tarfile.TarError, EOFError):
+                # If the server closed the connection early without an error, tarfile just sees the archive end too
+                # soon. That is a dropped download to retry, not a corrupt archive.
+                if reader.eof:
+                    _check_content_length(dl_obj, reader.n_bytes)
+                raise
+            finally:
+                n_bytes += reader.n_bytes
+            _check_content_length(dl_obj, reader.n_bytes)
+            finished = True
+            break
+        except (tarfile.TarError, EOFError) as err:
+            # A corrupted archive shows up here before we get to compare checksums
+            if keep_tar:
+                tar_copy.close()
+                os.remove(part_name)
+            raise IntegrityError('{} is not a valid archive: {}'.format(out_name, err))
+        except _transient_errors:
+            attempt += 1
+            if attempt > session.retries:
+                raise
+            time.sleep(session.backoff_time(attempt))
+        finally:
+            if tar_copy is not None:
+                tar_copy.close()
+            if dl_obj is not None:
+                dl_obj.close()
+            if not finished:
+                _remove_members(extract_path, members)
+
+    if expected is not None:
+        digest = reader.hasher.hexdigest() if reader.hasher is not None else None
+        try:
+            check_integrity(out_name, reader.n_bytes, digest, expected)
+        except IntegrityError:
+            if keep_tar:
+                os.remove(part_name)
+            _remove_members(extract_path, members)
+            raise
+
+    if keep_tar:
+        os.replace(part_name, out_name)
+    return n_bytes, members
+
+
+def extract_tar_file(filename, delete_tar=False, select=None, verbose=0, logging_fxn=print):
     """
     Extract individual files from a gzipped tar archive.
 
@@ -129,41 +713,31 @@ def extract_tar_file(filename, delete_tar=False, verbose=0, logging_fxn=print):
     :param delete_tar: optional, determines whether to delete the .tgz file after unarchiving. Default is ``False``.
     :type delete_tar: bool
 
+    :param select: optional, a function that takes a member name and returns ``True`` if it should be extracted, such
+        as one created by :func:`make_member_selector`. Default is ``None``, i.e. extract everything.
+    :type select: function or None
+
     :param verbose: Controls the logging verbosity. Default is 0
     :type verbose: int
 
     :param logging_fxn: optional, the function to call to print logging messages. Default is ``print``
     :type logging_fxn: function
 
-    :return: None
+    :return: the names of the files extracted, relative to the directory containing the archive
+    :rtype: list of str
     """
     extract_path = os.path.dirname(filename)
     with tarfile.open(filename, 'r:gz') as tarobj:
-        def is_within_directory(directory, target):
-            
-            abs_directory = os.path.abspath(directory)
-            abs_target = os.path.abspath(target)
-        
-            prefix = os.path.commonprefix([abs_directory, abs_target])
-            
-            return prefix == abs_directory
-        
-        def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-        
-            for member in tar.getmembers():
-                member_path = os.path.join(path, member.name)
-                if not is_within_directory(path, member_path):
-                    raise Exception("Attempted Path Traversal in Tar File")
-        
-            tar.extractall(path, members, numeric_owner=numeric_owner) 
-            
-        
-        safe_extract(tarobj, path=extract_path)
+        members = None if select is None else [m for m in tarobj.getmembers() if select(m.name)]
+        safe_extract(tarobj, path=extract_path, members=members)
+        members = [m.name for m in (tarobj.getmembers() if members is None else members) if m.isfile()]
     if delete_tar:
         if verbose > 0:
             logging_fxn('Deleting {}'.format(filename))
         os.remove(filename)
 
+    return members
+
 
 def iter_months(start, end):
     """
@@ -208,7 +782,312 @@ def iter_files_for_dates(filenames, start, end):
                 break  # break the inner loop, assume that there's only one file per month
 
 
-def download_and_extract(file_dict, start, end, out_dir='.', extract_tar=False, delete_tar=False, logging_fxn=print, verbose=0, **kwargs):
+def order_files(files, order='date', first_months=None):
+    """
+    Put BEHR monthly files in the order they should be downloaded.
+
+    :param files: the file name and URL pairs to download, in date order, as from :func:`iter_files_for_dates`
+    :type files: iterable of tuple
+
+    :param order: optional, "date" to download the oldest month first or "newest" for the newest month first. Default
+        is "date".
+    :type order: str
+
+    :param first_months: optional, months to download before any others, in the order given. Months not among
+        ``files`` are ignored. Default is ``None``.
+    :type first_months: list of datetime.datetime or None
+
+    :return: the file name and URL pairs in download order
+    :rtype: list of tuple
+    """
+    files = list(files)
+    if order == 'newest':
+        files.reverse()
+    elif order != 'date':
+        raise ValueError('order must be one of: {}'.format(', '.join(file_orders)))
+
+    if first_months:
+        month_strings = [m.strftime('%Y%m') for m in first_months]
+
+        def priority(item):
+            return next((i for i, m in enumerate(month_strings) if m in item[0]), len(month_strings))
+
+        # sorted is stable, so the remaining months stay in the order chosen above
+        files = sorted(files, key=priority)
+    return files
+
+
+def download_and_extract_one(fname, url, out_dir='.', extract_tar=False, delete_tar=False, stream=False, select=None, selection=None, expected=None, integrity_retries=2, block_size=default_block_size_bytes, progress_fxn=None, manifest=None, logging_fxn=print, verbose=0):
+    """
+    Download, and optionally extract, a single BEHR monthly .tar archive
+
+    :param fname: the file name to save the archive as, within ``out_dir``
+    :type fname: str
+
+    :param url: the DASH URL to download the archive from
+    :type url: str
+
+    :param select: optional, a function that takes a member name and returns ``True`` if it should be extracted, as
+        created by :func:`make_member_selector`. Default is ``None``, i.e. extract everything.
+    :type select: function or None
+
+    :param selection: optional, the days and pattern ``select`` was made from, as given by
+        :func:`~behrdownloader.manifest.member_selection`, to record in the manifest. Default is ``None``, i.e. all
+        members.
+    :type selection: dict or None
+
+    :param expected: optional, the DASH metadata for the archive to verify it against, as in the values of the
+        dictionary returned by :func:`get_dash_file_info_from_doi`. Default is ``None``, i.e. do not verify.
+    :type expected: dict or None
+
+    :param integrity_retries: optional, how many more times to download the archive if it fails verification. Default
+        is 2.
+    :type integrity_retries: int
+
+    :param block_size: optional, the size in bytes to read from the connection at once. Default is 4096.
+    :type block_size: int
+
+    :param progress_fxn: optional, a function called with the number of bytes in each block as it is received. An
+        exception raised by it stops the download. Default is ``None``.
+    :type progress_fxn: function or None
+
+    See :func:`download_and_extract` for the remaining parameters.
+
+    :return: the number of bytes downloaded
+    :rtype: int
+    """
+    save_name = os.path.join(out_dir, fname)
+    extract_tar = extract_tar or stream
+    n_bytes = 0
+    for attempt in range(integrity_retries + 1):
+        try:
+            if stream:
+                if verbose > 0:
+                    logging_fxn('Extracting {} into {} while downloading'.format(url, out_dir))
+                with metrics.phase('stream_extract', files=1) as counts:
+                    attempt_bytes, members = stream_extract_file(url, save_name, keep_tar=not delete_tar,
+                                                                 select=select, expected=expected,
+                                                                 block_size=block_size, progress_fxn=progress_fxn,
+                                                                 verbose=verbose, logging_fxn=logging_fxn)
+                    counts['bytes'] = attempt_bytes
+            else:
+                if verbose > 0:
+                    logging_fxn('Saving {} as {}'.format(url, save_name))
+                with metrics.phase('download', files=1) as counts:
+                    attempt_bytes = download_file(url, save_name, block_size=block_size, expected=expected,
+                                                  progress_fxn=progress_fxn)
+                    counts['bytes'] = attempt_bytes
+            n_bytes += attempt_bytes
+            break
+        except IntegrityError as err:
+            if attempt == integrity_retries:
+                raise
+            logging_fxn('{}; downloading it again'.format(err))
+
+    if not stream:
+        members = []
+        if extract_tar:
+            if verbose > 0:
+                logging_fxn('Extracting {}'.format(save_name))
+            with metrics.phase('extract') as counts:
+                members = extract_tar_file(save_name, delete_tar=delete_tar, select=select, verbose=verbose,
+                                           logging_fxn=logging_fxn)
+                counts['files'] = len(members)
+                counts['bytes'] = sum(os.path.getsize(os.path.join(out_dir, m)) for m in members)
+
+    if manifest is not None:
+        if selection is None:
+            selection = member_selection()
+        manifest.record(fname, members=members, tar_kept=not (extract_tar and delete_tar),
+                        selection=selection if extract_tar else None)
+
+    return n_bytes
+
+
+# Put on a pipeline queue after the last item, to tell the next stage there is nothing more coming
+_end_of_queue = object()
+
+
+class _PipelineStage():
+    """
+    One stage of :func:`pipeline_download_and_extract`: a set of threads that take items from one queue, process each
+    with a function, and put everything the function yields on the next queue. Time spent waiting for an item to
+    arrive is recorded as the metrics phase "<name>_idle" and time spent waiting for room in the next queue as
+    "<name>_blocked", which shows which stage is holding the pipeline up.
+    """
+    def __init__(self, name, fxn, n_threads, in_queue, out_queue, failures, logging_fxn):
+        self.name = name
+        self.fxn = fxn
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.failures = failures
+        self.logging_fxn = logging_fxn
+        self.threads = [threading.Thread(target=metrics.profile_thread(self._run), name='{}-{}'.format(name, i),
+                                         daemon=True)
+                        for i in range(n_threads)]
+
+    def start(self):
+        for t in self.threads:
+            t.start()
+        return self
+
+    def join(self):
+        for t in self.threads:
+            t.join()
+        if self.out_queue is not None:
+            self.out_queue.put(_end_of_queue)
+
+    def _run(self):
+        while True:
+            with metrics.phase(self.name + '_idle'):
+                item = self.in_queue.get()
+            if item is _end_of_queue:
+                # Leave it for the other threads of this stage to see
+                self.in_queue.put(_end_of_queue)
+                return
+
+            try:
+                for result in self.fxn(item):
+                    if self.out_queue is not None:
+                        with metrics.phase(self.name + '_blocked'):
+                            self.out_queue.put(result)
+            except Exception as err:
+                self.failures[item[0]] = err
+                self.logging_fxn('Failed to {} {}: {}'.format(self.name, item[0], err))
+
+
+def command_hook(command):
+    """
+    Make a post-processing function for :func:`pipeline_download_and_extract` that runs a command on each file.
+
+    :param command: the command to run. ``{}`` in it is replaced by the path of the file; if it does not contain
+        ``{}``, the path is added to the end. For example, ``"python2 BEHRvar_hdf2txt.py --format npz"``; the BEHR
+        converter scripts need Python 2, so name that interpreter rather than the Python 3 running this.
+    :type command: str
+
+    :return: a function that takes a file path and runs the command on it, raising
+        :class:`subprocess.CalledProcessError` if the command fails.
+    """
+    args = shlex.split(command)
+    if not any('{}' in a for a in args):
+        args.append('{}')
+
+    def run_command(path):
+        subprocess.run([a.replace('{}', path) for a in args], check=True)
+
+    return run_command
+
+
+def pipeline_download_and_extract(files, out_dir='.', delete_tar=False, select=None, selection=None, jobs=1,
+                                  extract_jobs=1, post_process=None, post_jobs=1, queue_size=default_queue_size,
+                                  block_size=default_block_size_bytes, file_info=None, manifest=None,
+                                  logging_fxn=print, verbose=0):
+    """
+    Download and extract BEHR monthly archives, and optionally post-process each extracted file, with the three steps
+    running at the same time on different files. While one month is being extracted, the next is downloading and the
+    files from the previous month are being post-processed, so the total time approaches that of the slowest step
+    rather than the sum of all three.
+
+    Each step has its own threads and hands its results to the next through a queue holding at most ``queue_size``
+    items. When a later step falls behind, the earlier one waits, so downloaded archives and extracted files do not
+    pile up on disk ahead of the slowest step.
+
+    A failure in one file is reported and the other files continue; a ``RuntimeError`` listing all the failed files
+    is raised once every file has gone through the pipeline.
+
+    :param files: the file name and URL pairs to download, as from :func:`iter_files_for_dates`
+    :type files: list of tuple
+
+    :param select: optional, a function that takes a member name and returns ``True`` if it should be extracted, as
+        created by :func:`make_member_selector`. Default is ``None``, i.e. extract everything.
+    :type select: function or None
+
+    :param selection: optional, the days and pattern ``select`` was made from, as given by
+        :func:`~behrdownloader.manifest.member_selection`, to record in the manifest. Default is ``None``, i.e. all
+        members.
+    :type selection: dict or None
+
+    :param jobs: optional, the number of archives to download at once. Default is 1.
+    :type jobs: int
+
+    :param extract_jobs: optional, the number of archives to extract at once. Default is 1.
+    :type extract_jobs: int
+
+    :param post_process: optional, a function to call with the path of each extracted file, for example one made by
+        :func:`command_hook`. Default is ``None``, i.e. no post-processing.
+    :type post_process: function or None
+
+    :param post_jobs: optional, the number of files to post-process at once. Default is 1.
+    :type post_jobs: int
+
+    :param queue_size: optional, how many downloaded archives may wait to be extracted, and how many extracted files
+        may wait to be post-processed. Default is 2.
+    :type queue_size: int
+
+    See :func:`download_and_extract` for the remaining parameters.
+
+    :return: None
+    """
+    if min(jobs, extract_jobs, post_jobs, queue_size) < 1:
+        raise ValueError('jobs, extract_jobs, post_jobs and queue_size must all be at least 1')
+    if file_info is None:
+        file_info = dict()
+
+    def download(item):
+        fname, url = item
+        download_and_extract_one(fname, url, out_dir=out_dir, expected=file_info.get(fname), block_size=block_size,
+                                 logging_fxn=logging_fxn, verbose=verbose)
+        yield fname, os.path.join(out_dir, fname)
+
+    def extract(item):
+        fname, save_name = item
+        if verbose > 0:
+            logging_fxn('Extracting {}'.format(save_name))
+        with metrics.phase('extract') as counts:
+            members = extract_tar_file(save_name, delete_tar=delete_tar, select=select, verbose=verbose,
+                                       logging_fxn=logging_fxn)
+            counts['files'] = len(members)
+            counts['bytes'] = sum(os.path.getsize(os.path.join(out_dir, m)) for m in members)
+        if manifest is not None:
+            manifest.record(fname, members=members, tar_kept=not delete_tar,
+                            selection=selection if selection is not None else member_selection())
+        for m in members:
+            yield m, os.path.join(out_dir, m)
+
+    def post(item):
+        member, path = item
+        if verbose > 0:
+            logging_fxn('Post-processing {}'.format(path))
+        with metrics.phase('post_process', files=1, bytes=os.path.getsize(path)):
+            post_process(path)
+        return ()
+
+    failures = dict()
+    download_queue = queue.Queue()
+    extract_queue = queue.Queue(maxsize=queue_size)
+    post_queue = queue.Queue(maxsize=queue_size) if post_process is not None else None
+    for f in files:
+        download_queue.put(f)
+    download_queue.put(_end_of_queue)
+
+    stages = [_PipelineStage('download', download, jobs, download_queue, extract_queue, failures, logging_fxn),
+              _PipelineStage('extract', extract, extract_jobs, extract_queue, post_queue, failures, logging_fxn)]
+    if post_process is not None:
+        stages.append(_PipelineStage('post_process', post, post_jobs, post_queue, None, failures, logging_fxn))
+    for stage in stages:
+        stage.start()
+    # Each stage is only told there is nothing more to come once all the threads of the stage before it are done
+    for stage in stages:
+        stage.join()
+
+    if len(failures) > 0:
+        raise RuntimeError('Failed to retrieve or process {} file(s): {}'.format(
+            len(failures), ', '.join(sorted(failures.keys()))
+        ))
+    logging_fxn('Completed {} files'.format(len(files)))
+
+
+def download_and_extract(file_dict, start, end, out_dir='.', extract_tar=False, delete_tar=False, stream=False, days=None, member_glob=None, jobs=1, block_size=default_block_size_bytes, file_info=None, manifest=None, order='date', first_months=None, pipeline=False, extract_jobs=1, post_process=None, post_jobs=1, queue_size=default_queue_size, logging_fxn=print, verbose=0, **kwargs):
     """
     Automatically download, and optionally extract, BEHR monthly .tar archives
 
@@ -233,6 +1112,64 @@ def download_and_extract(file_dict, start, end, out_dir='.', extract_tar=False,
         effect if ``extract_tar`` is ``False``. Default is ``False``.
     :type delete_tar: bool
 
+    :param stream: optional, extract the .hdf files as each archive is downloaded instead of reading the archive back
+        from disk afterwards. Implies ``extract_tar``. Combined with ``delete_tar``, the archive is never written to
+        disk at all. Interrupted archives cannot be resumed in this mode. Default is ``False``.
+    :type stream: bool
+
+    :param days: optional, only extract the files for these days of the month. Has no effect unless extracting.
+        Default is ``None``, i.e. extract all days.
+    :type days: collection of int or None
+
+    :param member_glob: optional, only extract files whose names match this shell-style pattern. Has no effect unless
+        extracting. Default is ``None``, i.e. extract all files.
+    :type member_glob: str or None
+
+    :param jobs: optional, the number of months to download at once. Default is 1, which downloads one file at a time
+        and stops at the first error. With more than one job, a failure in one file is reported and the other files
+        continue; a ``RuntimeError`` listing all the failed files is raised once every download has finished.
+    :type jobs: int
+
+    :param block_size: optional, the size in bytes to read from the connection at once. Default is 4096.
+    :type block_size: int
+
+    :param file_info: optional, the dictionary of file names to DASH metadata generated by
+        :func:`get_dash_file_info_from_doi`. If given, each archive is checked against the size and checksum DASH
+        reports as it is downloaded, and downloaded again (up to twice) if it does not match. Default is ``None``, i.e.
+        only check that each download is as long as the server said it would be.
+    :type file_info: dict or None
+
+    :param manifest: optional, a manifest to record each successfully downloaded file in. Default is ``None``, i.e.
+        do not record downloads. :func:`driver` passes a manifest for ``out_dir`` so that later "sync" actions know
+        what has been downloaded.
+    :type manifest: :class:`~behrdownloader.manifest.DashManifest` or None
+
+    :param order: optional, "date" to download the oldest month first or "newest" for the newest month first. With
+        more than one job, files start downloading in this order. Default is "date".
+    :type order: str
+
+    :param first_months: optional, months to download before any others, in the order given. Default is ``None``.
+    :type first_months: list of datetime.datetime or None
+
+    :param pipeline: optional, download, extract and post-process different months at the same time, with
+        :func:`pipeline_download_and_extract`. Implies ``extract_tar``; cannot be combined with ``stream``. Default is
+        ``False``.
+    :type pipeline: bool
+
+    :param extract_jobs: optional, with ``pipeline``, the number of archives to extract at once. Default is 1.
+    :type extract_jobs: int
+
+    :param post_process: optional, with ``pipeline``, a function to call with the path of each extracted file, or a
+        command to run on it (see :func:`command_hook`). Default is ``None``, i.e. no post-processing.
+    :type post_process: function, str or None
+
+    :param post_jobs: optional, with ``pipeline``, the number of files to post-process at once. Default is 1.
+    :type post_jobs: int
+
+    :param queue_size: optional, with ``pipeline``, how many items may wait between one step and the next. Default
+        is 2.
+    :type queue_size: int
+
     :param logging_fxn: optional, the function to call to print logging messages. Default is ``print``
     :type logging_fxn: function
 
@@ -253,16 +1190,199 @@ def download_and_extract(file_dict, start, end, out_dir='.', extract_tar=False,
     """
     if not os.path.isdir(out_dir):
         raise ValueError('outdir must be an existing directory')
+    if jobs < 1:
+        raise ValueError('jobs must be at least 1')
+    if pipeline and stream:
+        raise ValueError('pipeline and stream cannot be used together')
+    if post_process is not None and not pipeline:
+        raise ValueError('post_process requires pipeline')
+
+    files = order_files(iter_files_for_dates(file_dict, start, end), order=order, first_months=first_months)
+    if pipeline:
+        if isinstance(post_process, str):
+            post_process = command_hook(post_process)
+        return pipeline_download_and_extract(files, out_dir=out_dir, delete_tar=delete_tar,
+                                             select=make_member_selector(days=days, member_glob=member_glob),
+                                             selection=member_selection(days=days, member_glob=member_glob),
+                                             jobs=jobs, extract_jobs=extract_jobs, post_process=post_process,
+                                             post_jobs=post_jobs, queue_size=queue_size, block_size=block_size,
+                                             file_info=file_info, manifest=manifest, logging_fxn=logging_fxn,
+                                             verbose=verbose)
+    one_file_kwargs = {'out_dir': out_dir, 'extract_tar': extract_tar, 'delete_tar': delete_tar, 'stream': stream,
+                       'select': make_member_selector(days=days, member_glob=member_glob),
+                       'selection': member_selection(days=days, member_glob=member_glob), 'block_size': block_size,
+                       'manifest': manifest,
+                       'logging_fxn': logging_fxn, 'verbose': verbose}
+
+    if file_info is None:
+        file_info = dict()
+
+    if jobs == 1:
+        for fname, url in files:
+            download_and_extract_one(fname, url, expected=file_info.get(fname), **one_file_kwargs)
+        return
+
+    failures = dict()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(metrics.profile_thread(download_and_extract_one), fname, url,
+                                   expected=file_info.get(fname), **one_file_kwargs): fname
+                   for fname, url in files}
+        for n_done, future in enumerate(as_completed(futures), start=1):
+            fname = futures[future]
+            try:
+                total_bytes += future.result()
+            except Exception as err:
+                failures[fname] = err
+                logging_fxn('Failed to retrieve {}: {}'.format(fname, err))
+            logging_fxn('Completed {}/{} files ({} failed, {:.1f} MB downloaded)'.format(
+                n_done, len(files), len(failures), total_bytes / 1e6
+            ))
 
-    for fname, url in iter_files_for_dates(file_dict, start, end):
-        save_name = os.path.join(out_dir, fname)
-        if verbose > 0:
-            logging_fxn('Saving {} as {}'.format(url, save_name))
-        download_file(url, save_name)
-        if extract_tar:
+    if len(failures) > 0:
+        raise RuntimeError('Failed to retrieve {} of {} files: {}'.format(
+            len(failures), len(files), ', '.join(sorted(failures.keys()))
+        ))
+
+
+def sync_files(file_info, start, end, out_dir='.', logging_fxn=print, verbose=0, **kwargs):
+    """
+    Download, and optionally extract, only those BEHR monthly archives that are not already present in ``out_dir``.
+
+    Which archives are present is determined from the manifest kept in ``out_dir`` (see
+    :class:`~behrdownloader.manifest.DashManifest`), which records the DASH size and digest of every archive
+    downloaded into that directory and the files extracted from it. An archive is downloaded again if DASH now
+    reports a different size or digest for it, or if neither it nor all of its extracted files are still on disk.
+
+    :param file_info: the dictionary of BEHR monthly tar files mapped to their DASH metadata, generated by
+        :func:`get_dash_file_info_from_doi`.
+    :type file_info: dict
+
+    :param start: the first month of BEHR data to download
+    :type start: datetime.datetime
+
+    :param end: the last month of BEHR data to download
+    :type end: datetime.datetime
+
+    :param out_dir: the directory to save the files to. Default is ``"."``, i.e. the current directory.
+    :type out_dir: str
+
+    :param logging_fxn: optional, the function to call to print logging messages. Default is ``print``
+    :type logging_fxn: function
+
+    :param verbose: Controls the logging verbosity. Default is 0
+    :type verbose: int
+
+    :param kwargs: additional keyword arguments are passed through to :func:`download_and_extract`.
+
+    :return: None
+    """
+    if not os.path.isdir(out_dir):
+        raise ValueError('outdir must be an existing directory')
+
+    manifest = DashManifest(out_dir, file_info, logging_fxn=logging_fxn)
+    # An archive extracted with different --days or --member-glob (or not extracted at all) needs extracting again
+    extracting = kwargs.get('extract_tar') or kwargs.get('stream') or kwargs.get('pipeline')
+    selection = member_selection(days=kwargs.get('days'), member_glob=kwargs.get('member_glob')) if extracting else None
+    needed_files = dict()
+    n_current = 0
+    for fname, url in iter_files_for_dates(file_urls(file_info), start, end):
+        if manifest.is_current(fname, selection=selection):
+            n_current += 1
             if verbose > 0:
-                logging_fxn('Extracting {}'.format(save_name))
-            extract_tar_file(save_name, delete_tar=delete_tar, verbose=verbose, logging_fxn=logging_fxn)
+                logging_fxn('{} is up to date'.format(fname))
+        else:
+            needed_files[fname] = url
+
+    logging_fxn('{} file(s) up to date, {} to download'.format(n_current, len(needed_files)))
+    download_and_extract(needed_files, start, end, out_dir=out_dir, file_info=file_info, manifest=manifest,
+                         logging_fxn=logging_fxn, verbose=verbose, **kwargs)
+
+
+def verify_one(filename, expected):
+    """
+    Check a local archive against the size and checksum DASH reports for it.
+
+    :param filename: the path to the archive
+    :type filename: str
+
+    :param expected: the DASH metadata for the archive, as in the values of the dictionary returned by
+        :func:`get_dash_file_info_from_doi`.
+    :type expected: dict
+
+    :return: ``None`` if the archive matches, otherwise a message describing the problem
+    :rtype: None or str
+    """
+    try:
+        with metrics.phase('verify', files=1, bytes=os.path.getsize(filename)):
+            digest = file_digest(filename, expected['digest_type']) if expected.get('digest') is not None else None
+            check_integrity(filename, os.path.getsize(filename), digest, expected)
+    except IntegrityError as err:
+        return str(err)
+    return None
+
+
+def verify_files(file_info, start, end, out_dir='.', jobs=1, logging_fxn=print, verbose=0, **kwargs):
+    """
+    Check previously downloaded BEHR monthly archives against the size and checksum DASH reports for them.
+
+    Archives not present in ``out_dir`` (never downloaded, or deleted after extracting) are skipped.
+
+    :param file_info: the dictionary of BEHR monthly tar files mapped to their DASH metadata, generated by
+        :func:`get_dash_file_info_from_doi`.
+    :type file_info: dict
+
+    :param start: the first month of BEHR data to verify
+    :type start: datetime.datetime
+
+    :param end: the last month of BEHR data to verify
+    :type end: datetime.datetime
+
+    :param out_dir: the directory the files were downloaded to. Default is ``"."``, i.e. the current directory.
+    :type out_dir: str
+
+    :param jobs: optional, the number of files to check at once. Default is 1.
+    :type jobs: int
+
+    :param logging_fxn: optional, the function to call to print logging messages. Default is ``print``
+    :type logging_fxn: function
+
+    :param verbose: Controls the logging verbosity. Default is 0
+    :type verbose: int
+
+    :param kwargs: unused, present to consume extra command link arguments passed through.
+
+    :return: None
+    :raises RuntimeError: if any of the archives do not match, after all have been checked.
+    """
+    if not os.path.isdir(out_dir):
+        raise ValueError('outdir must be an existing directory')
+    if jobs < 1:
+        raise ValueError('jobs must be at least 1')
+
+    to_check = []
+    for fname, info in iter_files_for_dates(file_info, start, end):
+        filename = os.path.join(out_dir, fname)
+        if os.path.isfile(filename):
+            to_check.append((fname, filename, info))
+        elif verbose > 0:
+            logging_fxn('{} is not present, skipping'.format(fname))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        problems = list(executor.map(metrics.profile_thread(lambda task: verify_one(task[1], task[2])), to_check))
+
+    bad_files = []
+    for (fname, filename, info), problem in zip(to_check, problems):
+        if problem is not None:
+            bad_files.append(fname)
+            logging_fxn('FAILED: {}'.format(problem))
+        elif verbose > 0:
+            logging_fxn('OK: {}'.format(filename))
+
+    logging_fxn('{} of {} archives verified OK'.format(len(to_check) - len(bad_files), len(to_check)))
+    if len(bad_files) > 0:
+        raise RuntimeError('{} archives failed verification: {}. Delete them and rerun "sync" to download them '
+                           'again.'.format(len(bad_files), ', '.join(bad_files)))
 
 
 def list_files(file_dict, start, end, out_file=None, link_format='raw', **kwargs):
@@ -320,7 +1440,9 @@ def list_files(file_dict, start, end, out_file=None, link_format='raw', **kwargs
     return links
 
 
-def driver(dataset, start, end, action, verbose=0, **kwargs):
+def driver(dataset, start, end, action, refresh=False, cache_ttl=default_cache_ttl_s, retries=dash_session.default_retries,
+           timeout=dash_session.default_timeout_s, max_rate=None, max_per_host=None, metrics_out=None, profile=None,
+           verbose=0, **kwargs):
     """
     Main function to download or get links for BEHR files for a given date range.
 
@@ -337,19 +1459,55 @@ def driver(dataset, start, end, action, verbose=0, **kwargs):
     :param end: the last month of BEHR data to retrieve
     :type end: datetime.datetime
 
-    :param action: controls whether to list the download links ("list") or directly download the files ("download")
+    :param action: controls whether to list the download links ("list"), directly download the files ("download"),
+        download only the files not already present in the output directory ("sync"), or check the files already in
+        the output directory against DASH's sizes and checksums ("verify")
     :type action: str
 
+    :param refresh: optional, set to ``True`` to ignore the cached DASH file listing. Default is ``False``.
+    :type refresh: bool
+
+    :param cache_ttl: optional, how long in seconds a cached DASH file listing is trusted without checking whether the
+        dataset has a new version. Default is one day.
+    :type cache_ttl: int or float
+
+    :param retries: optional, how many times to retry a DASH request that fails with a connection error, a dropped
+        download, or a 429 or 5xx status. Default is 5.
+    :type retries: int
+
+    :param timeout: optional, the timeout in seconds for DASH requests, either a single number or a (connect, read)
+        tuple. Default is 10 seconds to connect and 60 seconds between bytes received.
+    :type timeout: float or tuple
+
+    :param max_rate: optional, the most data to download per second, in MB, over all downloads together. Default is
+        ``None``, i.e. no limit.
+    :type max_rate: float or None
+
+    :param max_per_host: optional, the most connections to open to any one host at once. Default is ``None``, i.e.
+        one per job.
+    :type max_per_host: int or None
+
+    :param metrics_out: optional, a file to write the time spent and data moved in each phase of the run (listing,
+        downloading, extracting, verifying) to, as JSON. It is written even if the action fails. Default is ``None``,
+        i.e. do not write metrics.
+    :type metrics_out: str or None
+
+    :param profile: optional, a file to save :mod:`cProfile` statistics for the run to, for reading with
+        :mod:`pstats`. Default is ``None``, i.e. do not profile.
+    :type profile: str or None
+
     :param verbose: Controls the logging verbosity. Default is 0
     :type verbose: int
 
     :param kwargs: Additional keyword arguments accepted, either from the command line parsing or in a direct call.
-        These are passed to the :func:`list_files` function if ``action`` is ``"list"`` or :func:`download_and_extract`
-        function if ``action`` is ``"download"``; see those files' documentation for additional keyword arguments
-        accepted/required.
-
-    :return: return value of :func:`list_files` if ``action`` is ``"list"`` or :func:`download_and_extract` if ``action``
-        is ``"download"``
+        These are passed to the :func:`list_files` function if ``action`` is ``"list"``, :func:`download_and_extract`
+        function if ``action`` is ``"download"``, :func:`sync_files` if ``action`` is ``"sync"``, or
+        :func:`verify_files` if ``action`` is ``"verify"``; see those files' documentation for additional keyword
+        arguments accepted/required.
+
+    :return: return value of :func:`list_files` if ``action`` is ``"list"``, :func:`download_and_extract` if ``action``
+        is ``"download"``, :func:`sync_files` if ``action`` is ``"sync"``, or :func:`verify_files` if ``action`` is
+        ``"verify"``
     """
     if not dataset.startswith('doi'):
         try:
@@ -359,18 +1517,70 @@ def driver(dataset, start, end, action, verbose=0, **kwargs):
                 ', '.join(behr_dois.keys())
             ))
 
-    file_dict = get_dash_files_from_doi(dataset)
-
-    if action.lower() == 'download':
-        return download_and_extract(file_dict=file_dict, start=start, end=end, verbose=verbose, **kwargs)
-    elif action.lower() == 'list':
-        return list_files(file_dict=file_dict, start=start, end=end, **kwargs)
+    dash_session.configure_session(retries=retries, timeout=timeout,
+                                   pool_size=max(kwargs.get('jobs', 1), dash_session.default_pool_size),
+                                   max_rate=max_rate * 1e6 if max_rate is not None else None,
+                                   max_per_host=max_per_host)
+    t0 = time.time()
+    with metrics.collecting() as run_metrics:
+        try:
+            with metrics.profiled(profile):
+                file_info = get_dash_file_info_from_doi(dataset, refresh=refresh, cache_ttl=cache_ttl)
+                file_dict = file_urls(file_info)
+
+                if action.lower() == 'download':
+                    manifest = DashManifest(kwargs.get('out_dir', '.'), file_info,
+                                           logging_fxn=kwargs.get('logging_fxn', print))
+                    return download_and_extract(file_dict=file_dict, start=start, end=end, file_info=file_info,
+                                                manifest=manifest, verbose=verbose, **kwargs)
+                elif action.lower() == 'sync':
+                    return sync_files(file_info=file_info, start=start, end=end, verbose=verbose, **kwargs)
+                elif action.lower() == 'verify':
+                    return verify_files(file_info=file_info, start=start, end=end, verbose=verbose, **kwargs)
+                elif action.lower() == 'list':
+                    return list_files(file_dict=file_dict, start=start, end=end, **kwargs)
+        finally:
+            if metrics_out is not None:
+                run_metrics.write(metrics_out, time.time() - t0, action=action, dataset=dataset,
+                                  start=start.strftime('%Y-%m'), end=end.strftime('%Y-%m'),
+                                  jobs=kwargs.get('jobs', 1), stream=kwargs.get('stream', False))
 
 
 def parse_cl_date(date_string):
     return dt.datetime.strptime(date_string, '%Y-%m')
 
 
+def parse_cl_months(months_string):
+    try:
+        return [parse_cl_date(m) for m in months_string.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{}" is not a comma separated list of yyyy-mm months'.format(months_string))
+
+
+def parse_cl_days(days_string):
+    """
+    Parse a list of days of the month given on the command line, e.g. "1-5,10,20-22".
+
+    :param days_string: comma separated days or ranges of days
+    :type days_string: str
+
+    :return: the days of the month listed
+    :rtype: set of int
+    """
+    days = set()
+    for part in days_string.split(','):
+        first, _, last = part.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise argparse.ArgumentTypeError('"{}" is not a day or range of days'.format(part))
+        if not 1 <= first <= last <= 31:
+            raise argparse.ArgumentTypeError('"{}" is not a valid day or range of days'.format(part))
+        days.update(range(first, last + 1))
+    return days
+
+
 def parse_args(parser=None):
     """
     Parse command line arguments, or add the arguments to a given parser.
@@ -388,11 +1598,34 @@ def parse_args(parser=None):
     if not called_as_subcommand:
         parser = argparse.ArgumentParser(description=description, epilog=epilog)
 
-    parser.add_argument('action', choices=['list', 'download'], help='What action to take. "list" will ')
+    parser.add_argument('action', choices=['list', 'download', 'sync', 'verify'],
+                        help='What action to take. "list" will print the download links, "download" will download '
+                             'the files, "sync" will download only the files not already present in the output '
+                             'directory, and "verify" will check the files already in the output directory against '
+                             'the sizes and checksums reported by DASH.')
     parser.add_argument('dataset', choices=behr_dois.keys(), help='Which dataset to download.')
     parser.add_argument('start', type=parse_cl_date, help='Beginning date to download in yyyy-mm format.')
     parser.add_argument('end', type=parse_cl_date, help='Ending date to download in yyyy-mm format.')
-    parser.add_argument('-v', '--verbose', action='count', help='Increase logging to console.')
+    parser.add_argument('-v', '--verbose', action='count', default=0, help='Increase logging to console.')
+    parser.add_argument('--refresh', action='store_true', help='Ignore the cached list of files on DASH and list them again.')
+    parser.add_argument('--cache-ttl', type=float, default=default_cache_ttl_s,
+                        help='How long in seconds to trust the cached list of files on DASH before checking whether '
+                             'the dataset has a new version. Default is %(default)s.')
+    parser.add_argument('--retries', type=int, default=dash_session.default_retries,
+                        help='How many times to retry a DASH request that fails with a connection error, a dropped '
+                             'download, or a 429 or 5xx status. Default is %(default)s.')
+    parser.add_argument('--timeout', type=float, default=dash_session.default_timeout_s,
+                        help='Timeout in seconds for each DASH request. Default is {} seconds to connect and {} seconds '
+                             'between bytes received.'.format(*dash_session.default_timeout_s))
+    parser.add_argument('--max-rate', type=float,
+                        help='Most data to download per second, in MB, over all downloads together. Default is no '
+                             'limit.')
+    parser.add_argument('--max-per-host', type=int,
+                        help='Most connections to open to any one host at once. Default is one per job.')
+    parser.add_argument('--metrics-out', help='Write the time spent and data moved in each phase (listing, downloading, '
+                                              'extracting, verifying) to this JSON file.')
+    parser.add_argument('--profile', help='Run under cProfile and save the statistics to this file, for reading with '
+                                          'python -m pstats.')
 
     list_args = parser.add_argument_group(title='List', description='Arguments specific to the "list" action')
     list_args.add_argument('-f', '--out-file', default='-', help='File to save the URLs to. By default, they are just printed to stdout.')
@@ -402,10 +1635,44 @@ def parse_args(parser=None):
                                 'that can be executed as a Bash script, and "powershell", which creates a list of download '
                                 'commands that can be executed as a PowerShell script.')
 
-    download_args = parser.add_argument_group(title='Download', description='Arguments specific to the "download" action')
+    download_args = parser.add_argument_group(title='Download', description='Arguments specific to the "download" and "sync" actions. '
+                                                                            '--out-dir and --jobs also apply to "verify".')
     download_args.add_argument('-o', '--out-dir', default='.', help='Directory to save downloads to. Default is the current directory.')
     download_args.add_argument('-e', '--extract-tar', action='store_true', help='Extract the tar files after downloading')
-    download_args.add_argument('-d', '--delete-tar', action='store_true', help='Delete tar file after extracting. Has no effect without --extract-tar.')
+    download_args.add_argument('-d', '--delete-tar', action='store_true', help='Delete tar file after extracting. Has no effect without --extract-tar or --stream.')
+    download_args.add_argument('-s', '--stream', action='store_true',
+                               help='Extract the .hdf files while downloading, rather than saving the tar file and '
+                                    'reading it back. Implies --extract-tar. With --delete-tar, the tar file is never '
+                                    'saved at all.')
+    download_args.add_argument('--days', type=parse_cl_days,
+                               help='Only extract files for these days of the month, e.g. "1-5,10". Has no effect '
+                                    'without --extract-tar or --stream.')
+    download_args.add_argument('--member-glob',
+                               help='Only extract files whose names match this shell-style pattern, e.g. '
+                                    '"*_20050615.hdf". Has no effect without --extract-tar or --stream.')
+    download_args.add_argument('-j', '--jobs', type=int, default=1, help='Number of files to download at once. Default is 1.')
+    download_args.add_argument('--order', choices=file_orders, default='date',
+                               help='Download the oldest ("date") or newest ("newest") months first. Default is '
+                                    '%(default)s.')
+    download_args.add_argument('--first', dest='first_months', type=parse_cl_months,
+                               help='Months to download before any others, in yyyy-mm format separated by commas, '
+                                    'e.g. "2012-07,2012-01".')
+    download_args.add_argument('--block-size', type=int, default=default_block_size_bytes,
+                               help='Size in bytes to read from the connection at once. Default is %(default)s.')
+    download_args.add_argument('-p', '--pipeline', action='store_true',
+                               help='Download, extract and post-process different months at the same time. Implies '
+                                    '--extract-tar; cannot be used with --stream.')
+    download_args.add_argument('--extract-jobs', type=int, default=1,
+                               help='With --pipeline, number of archives to extract at once. Default is %(default)s.')
+    download_args.add_argument('--post-process',
+                               help='With --pipeline, a command to run on each extracted file. {} in the command is '
+                                    'replaced by the file\'s path, otherwise the path is added to the end, e.g. '
+                                    '"python2 BEHRvar_hdf2txt.py --format npz" (the BEHR converters need Python 2).')
+    download_args.add_argument('--post-jobs', type=int, default=1,
+                               help='With --pipeline, number of files to post-process at once. Default is %(default)s.')
+    download_args.add_argument('--queue-size', type=int, default=default_queue_size,
+                               help='With --pipeline, how many archives may wait to be extracted, and extracted files '
+                                    'to be post-processed, before the step before waits. Default is %(default)s.')
 
     parser.set_defaults(driver_fxn=driver)
 
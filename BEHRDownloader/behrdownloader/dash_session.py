@@ -0,0 +1,185 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import metrics
+
+default_retries = 5
+default_backoff_factor = 1.0
+default_timeout_s = (10, 60)
+default_pool_size = 10
+
+# Responses with these status codes are considered transient and retried
+retry_status_codes = (429, 500, 502, 503, 504)
+
+"""
+A single, shared HTTP session for all requests to DASH. Using one session means connections are kept alive and reused
+between the many pagination requests and downloads, rather than opening a new TCP/TLS connection each time, and
+lets transient failures (dropped connections, throttling, server errors) be retried with exponential backoff.
+"""
+
+
+class TokenBucket():
+    """
+    A token bucket rate limiter shared by any number of threads. Tokens (bytes) are added at ``rate`` per second, up to
+    ``capacity``; taking more tokens than are in the bucket makes the caller sleep until the bucket would have had
+    them. Since every thread takes from the same bucket, the limit applies to all of them together.
+
+    :param rate: the average rate allowed, in bytes per second
+    :type rate: float
+
+    :param capacity: optional, how many bytes may be taken in a burst after a pause. Default is one second's worth.
+    :type capacity: float
+    """
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError('rate must be greater than 0')
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        """
+        Take ``n`` tokens, sleeping first if there are not enough.
+
+        :param n: the number of tokens (bytes) to take
+        :type n: int
+
+        :return: how long the caller slept, in seconds
+        :rtype: float
+        """
+        # The tokens are taken straight away, possibly leaving the bucket in debt, and the caller then sleeps until
+        # the debt is paid off. Later callers see the debt and wait behind it, so threads are served in turn.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class DashSession(requests.Session):
+    """
+    A :class:`requests.Session` with connection pooling, automatic retries and a default timeout.
+
+    :param retries: the number of times to retry a request that fails to connect or that returns one of the
+        ``retry_status_codes``. Default is 5.
+    :type retries: int
+
+    :param backoff_factor: retries wait ``backoff_factor * 2 ** (n - 1)`` seconds before the nth retry. A
+        ``Retry-After`` header from the server takes precedence. Default is 1.
+    :type backoff_factor: float
+
+    :param timeout: the timeout in seconds for requests that do not give one, either a single number or a
+        (connect, read) tuple. Default is 10 seconds to connect and 60 seconds between bytes received.
+    :type timeout: float or tuple
+
+    :param pool_size: the number of connections to keep open to each host. This should be at least the number of
+        threads making requests at once. Default is 10.
+    :type pool_size: int
+
+    :param max_rate: optional, the most bytes per second to download, over all threads together. Code reading
+        response bodies must call :meth:`throttle` for this to take effect. Default is ``None``, i.e. no limit.
+    :type max_rate: float or None
+
+    :param max_per_host: optional, the most connections to open to any one host at once. Requests beyond this wait
+        for a connection to be released, however many threads are making them. Default is ``None``, i.e. up to
+        ``pool_size`` connections are kept, and more are opened (and then discarded) if needed.
+    :type max_per_host: int or None
+    """
+    def __init__(self, retries=default_retries, backoff_factor=default_backoff_factor, timeout=default_timeout_s,
+                 pool_size=default_pool_size, max_rate=None, max_per_host=None):
+        super(DashSession, self).__init__()
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.rate_limiter = TokenBucket(max_rate) if max_rate is not None else None
+
+        # raise_on_status=False returns the last response once the retries are used up, so that the caller's
+        # raise_for_status() reports the actual HTTP error.
+        retry = Retry(total=retries, backoff_factor=backoff_factor, status_forcelist=retry_status_codes,
+                      raise_on_status=False)
+        # urllib3 keeps a pool of connections per host. With pool_block, a full pool makes requests wait for a free
+        # connection rather than opening an extra one, which caps the connections to each host.
+        if max_per_host is not None:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=max_per_host, pool_block=True,
+                                  max_retries=retry)
+        else:
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(DashSession, self).request(method, url, **kwargs)
+
+    def backoff_time(self, attempt):
+        """
+        Get how long to wait before a retry that the session does not handle itself, such as resuming a download
+        that dropped part way through.
+
+        :param attempt: which retry this is, starting from 1
+        :type attempt: int
+
+        :return: the time to wait in seconds
+        :rtype: float
+        """
+        return self.backoff_factor * 2 ** (attempt - 1)
+
+    def throttle(self, n_bytes):
+        """
+        Account for bytes received, sleeping if that puts the session over its ``max_rate``. Does nothing if the
+        session has no rate limit.
+
+        :param n_bytes: the number of bytes just received
+        :type n_bytes: int
+
+        :return: None
+        """
+        if self.rate_limiter is not None:
+            wait = self.rate_limiter.consume(n_bytes)
+            if wait > 0:
+                metrics.add('throttle', wait)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def configure_session(**kwargs):
+    """
+    Replace the shared session with one using new settings.
+
+    :param kwargs: keyword arguments accepted by :class:`DashSession`.
+
+    :return: the new session
+    :rtype: :class:`DashSession`
+    """
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = DashSession(**kwargs)
+        return _session
+
+
+def get_session():
+    """
+    Get the shared session, creating it with the default settings if :func:`configure_session` has not been called.
+
+    :return: the shared session
+    :rtype: :class:`DashSession`
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = DashSession()
+        return _session
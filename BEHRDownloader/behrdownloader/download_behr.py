@@ -1,17 +1,41 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 from datetime import datetime as dtime, timedelta as tdel
-import urllib2
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+try:
+    from urllib2 import urlopen, Request, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError, URLError
 
 __metaclass__ = type  # Automatically makes Python 2 classes inherit from object to be new-style classes
 
 version_file = 'http://behr.cchem.berkeley.edu/behr/behr_version.txt'
+file_root = 'http://behr.cchem.berkeley.edu/behr/behr_hdf'
 name_fmt_string = 'OMI_BEHR-{}_{}_{}_{}.hdf'
 
-def get_current_behr_version():
-    # Only read 32 characters from the file - that should be more than enough for a version string like v3-0Arev1 and
-    # prevents flooding the user's computer with unnecessary data
-    version_string = urllib2.urlopen(version_file).read(32)
-    return version_string
+# How long to reuse the version read from version_file before reading it again, in seconds
+version_cache_ttl_s = 3600
+default_probe_workers = 16
+default_probe_timeout_s = 10
+default_probe_retries = 2
+
+_version_cache = {'version': None, 'fetched': 0.0}
+_version_lock = threading.Lock()
+
+def get_current_behr_version(max_age=version_cache_ttl_s):
+    # The version changes rarely, so it is only read from the server once per max_age seconds rather than every time
+    # a file list is made. Pass max_age=0 to force it to be read again.
+    with _version_lock:
+        if _version_cache['version'] is None or time.time() - _version_cache['fetched'] >= max_age:
+            # Only read 32 characters from the file - that should be more than enough for a version string like
+            # v3-0Arev1 and prevents flooding the user's computer with unnecessary data
+            version_string = urlopen(version_file).read(32)
+            _version_cache['version'] = version_string.decode('ascii').strip()
+            _version_cache['fetched'] = time.time()
+        return _version_cache['version']
 
 def iter_file_list(region, profile_mode, start_date, end_date):
     start_dt = dtime.strptime(start_date, '%Y-%m-%d')
@@ -25,6 +49,50 @@ def iter_file_list(region, profile_mode, start_date, end_date):
         yield file_name
         curr_dt += one_day
 
-def print_file_list_debug(region, profile_mode, start_date, end_date):
-    for f in iter_file_list(region, profile_mode, start_date, end_date):
-        print(f)
\ No newline at end of file
+def file_url(file_name, root=None):
+    if root is None:
+        root = file_root
+    return '{}/{}'.format(root.rstrip('/'), file_name)
+
+def file_exists(url, timeout=default_probe_timeout_s, retries=default_probe_retries):
+    # Ask for just the headers of the file. A 404 (or 403, which some servers send for missing files) means it does not
+    # exist; connection problems and other errors are retried, then raised.
+    request = Request(url)
+    request.get_method = lambda: 'HEAD'
+    for attempt in range(retries + 1):
+        try:
+            urlopen(request, timeout=timeout).close()
+            return True
+        except HTTPError as err:
+            if err.code in (403, 404, 410):
+                return False
+            elif attempt == retries:
+                raise
+        except URLError:
+            if attempt == retries:
+                raise
+        time.sleep(2 ** attempt)
+
+def iter_existing_files(region, profile_mode, start_date, end_date, root=None, workers=default_probe_workers,
+                        timeout=default_probe_timeout_s):
+    # Check all the file names iter_file_list would give at once with HEAD requests from a pool of threads, so a
+    # multi-year list takes seconds rather than one round trip per day. Files are yielded in date order, as name and
+    # URL pairs, skipping the days that have no file.
+    urls = [(f, file_url(f, root=root)) for f in iter_file_list(region, profile_mode, start_date, end_date)]
+    pool = ThreadPool(workers)
+    try:
+        exists = pool.imap(lambda u: file_exists(u[1], timeout=timeout), urls)
+        for (file_name, url), found in zip(urls, exists):
+            if found:
+                yield file_name, url
+    finally:
+        pool.terminate()
+        pool.join()
+
+def print_file_list_debug(region, profile_mode, start_date, end_date, check_exists=False):
+    if check_exists:
+        for f, url in iter_existing_files(region, profile_mode, start_date, end_date):
+            print(url)
+    else:
+        for f in iter_file_list(region, profile_mode, start_date, end_date):
+            print(f)
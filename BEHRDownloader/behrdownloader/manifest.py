@@ -0,0 +1,168 @@
+import datetime as dt
+import json
+import os
+import threading
+
+
+def member_selection(days=None, member_glob=None):
+    """
+    Describe which members of an archive were (or are to be) extracted, in a form that can be saved in the manifest
+    and compared, as :meth:`DashManifest.record` and :meth:`DashManifest.is_current` take.
+
+    :param days: the days of the month extracted, or ``None`` for all days.
+    :type days: collection of int or None
+
+    :param member_glob: the shell-style pattern extracted member names matched, or ``None`` for all names.
+    :type member_glob: str or None
+
+    :return: the selection
+    :rtype: dict
+    """
+    return {'days': sorted(days) if days is not None else None, 'member_glob': member_glob}
+
+
+class DashManifest():
+    """
+    Record of which DASH archives have already been downloaded (and possibly extracted) into a local directory.
+
+    The manifest is a JSON file kept in the download directory. For each archive it stores the size and digest
+    DASH reported when it was downloaded, the DASH dataset version, when it was downloaded, the local modification
+    time of the archive, whether the archive was kept after extracting, and the names of the extracted members. This
+    lets :func:`behrdownloader.dash_interface.sync_files` tell whether a month is already present even if the .tgz
+    was deleted after extracting.
+
+    :param directory: the download directory that the manifest describes
+    :type directory: str
+
+    :param remote_files: the dictionary of file names to DASH file metadata generated by
+        :func:`behrdownloader.dash_interface.get_dash_file_info_from_doi`. Entries are compared against, and recorded
+        from, this metadata.
+    :type remote_files: dict
+
+    :param filename: optional, the name of the manifest file within ``directory``.
+    :type filename: str
+
+    :param logging_fxn: optional, the function to call to print logging messages. Default is ``print``
+    :type logging_fxn: function
+    """
+    default_filename = '.behr_dash_manifest.json'
+
+    def __init__(self, directory, remote_files, filename=default_filename, logging_fxn=print):
+        self.directory = directory
+        self.path = os.path.join(directory, filename)
+        self.remote_files = remote_files
+        self.logging_fxn = logging_fxn
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return dict()
+        try:
+            with open(self.path) as fobj:
+                return json.load(fobj)['files']
+        except (ValueError, KeyError, TypeError) as err:
+            # A damaged manifest (e.g. from an interrupted sync) is not worth failing over, the archives on disk are
+            # checked again and anything missing downloaded
+            self.logging_fxn('Ignoring unreadable manifest {} ({})'.format(self.path, err))
+            return dict()
+
+    def save(self):
+        """
+        Write the manifest to disk. The file is written under a temporary name then renamed, so an interrupted save
+        does not lose the existing manifest.
+
+        :return: None
+        """
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fobj:
+            json.dump({'files': self.entries}, fobj, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def _matches_remote(self, entry, remote):
+        for key in ('size', 'digest'):
+            if remote.get(key) is not None and entry.get(key) != remote.get(key):
+                return False
+        return True
+
+    def is_current(self, fname, selection=None):
+        """
+        Check whether a DASH archive is already present locally and unchanged on DASH.
+
+        An archive counts as present if either the .tgz file itself is on disk with the expected size or every
+        member extracted from it is still on disk. A kept .tgz file whose modification time no longer matches the one
+        recorded when it was downloaded has been changed or replaced since, so does not count. If ``selection`` is
+        given, the members extracted from the archive must still be on disk; the .tgz alone is not enough. An archive
+        downloaded before the manifest existed is adopted into the manifest if its size matches what DASH reports
+        and it is not wanted extracted, since there is no record of what was extracted from it.
+
+        :param fname: the archive file name, as given by DASH
+        :type fname: str
+
+        :param selection: optional, the members that are wanted extracted, from :func:`member_selection`. If given,
+            an archive recorded with a different selection (or that was not extracted) is not current. Default is
+            ``None``, i.e. the archive is not being extracted so any extraction recorded will do.
+        :type selection: dict or None
+
+        :return: ``True`` if the archive does not need to be downloaded again, ``False`` otherwise.
+        :rtype: bool
+        """
+        remote = self.remote_files.get(fname, dict())
+        tar_path = os.path.join(self.directory, fname)
+        tar_present = os.path.isfile(tar_path) and (remote.get('size') is None or
+                                                    os.path.getsize(tar_path) == remote['size'])
+
+        entry = self.entries.get(fname)
+        if entry is None:
+            if tar_present and remote.get('size') is not None and selection is None:
+                self.record(fname, members=[], tar_kept=True)
+                return True
+            return False
+
+        if not self._matches_remote(entry, remote):
+            return False
+        if selection is not None and entry.get('selection') != selection:
+            return False
+        if tar_present and entry.get('local_mtime') is not None and os.path.getmtime(tar_path) != entry['local_mtime']:
+            return False
+
+        members = entry.get('members', [])
+        if selection is not None:
+            return all(os.path.exists(os.path.join(self.directory, m)) for m in members)
+        members_present = len(members) > 0 and all(os.path.exists(os.path.join(self.directory, m)) for m in members)
+        return tar_present or members_present
+
+    def record(self, fname, members, tar_kept, selection=None):
+        """
+        Add or replace the manifest entry for an archive and save the manifest.
+
+        :param fname: the archive file name, as given by DASH
+        :type fname: str
+
+        :param members: the names of the files extracted from the archive, relative to the download directory. Empty
+            if the archive was not extracted.
+        :type members: list of str
+
+        :param tar_kept: whether the .tgz archive itself remains on disk.
+        :type tar_kept: bool
+
+        :param selection: the members that were extracted, from :func:`member_selection`, or ``None`` if the archive
+            was not extracted.
+        :type selection: dict or None
+
+        :return: None
+        """
+        remote = self.remote_files.get(fname, dict())
+        tar_path = os.path.join(self.directory, fname)
+        entry = {'size': remote.get('size'),
+                 'digest': remote.get('digest'),
+                 'digest_type': remote.get('digest_type'),
+                 'version': remote.get('version'),
+                 'downloaded': dt.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                 'local_mtime': os.path.getmtime(tar_path) if tar_kept and os.path.isfile(tar_path) else None,
+                 'members': list(members),
+                 'selection': selection,
+                 'tar_kept': tar_kept}
+        with self._lock:
+            self.entries[fname] = entry
+            self.save()
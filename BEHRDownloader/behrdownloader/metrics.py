@@ -0,0 +1,244 @@
+# This module is also imported by the Python 2 converter scripts in BEHRWebTools (through metricsBEHR.py), so unlike
+# the rest of the package it must stay Python 2 compatible. tests/test_metrics.py checks that it imports in Python 2.
+from __future__ import absolute_import, division, print_function
+from collections import OrderedDict
+import contextlib
+import cProfile
+import datetime as dt
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+
+# resource is not available on Windows, in which case peak memory is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+"""
+Timing and throughput instrumentation for the downloader. Code being measured records to the module level
+:func:`phase` and :func:`add`, so that the metrics do not need passing down to every function; :func:`collecting`
+starts a fresh set for one run, as :func:`~behrdownloader.dash_interface.driver` does for its ``--metrics-out`` option.
+"""
+
+# Python 2 has no os.replace, but os.rename does the same thing everywhere except Windows
+_replace = getattr(os, 'replace', os.rename)
+
+# The amounts that can be counted for each phase, besides its time and number of calls
+counters = ('bytes', 'files', 'pixels')
+
+
+class PhaseMetrics(object):
+    """
+    The wall time spent in, and the amount of data handled by, each named phase of a run, such as "listing" or
+    "download". Every time a phase runs, its time and its counts of bytes, files and pixels are added to the totals for
+    that phase, so the report shows both where the time went and how fast each phase moved data.
+
+    Phases may be nested, so the times of all the phases need not add up to the run's wall time. When phases run in
+    several threads at once (e.g. downloads with ``jobs > 1``), their times add up across the threads, so a phase's
+    throughput is the rate of one thread.
+    """
+    def __init__(self):
+        self.phases = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds=0.0, calls=1, **counts):
+        """
+        Add to the totals for one phase.
+
+        :param name: the phase
+        :type name: str
+
+        :param seconds: the time spent in the phase
+        :type seconds: float
+
+        :param calls: how many times the phase ran
+        :type calls: int
+
+        :param counts: the bytes, files and/or pixels the phase handled, as keyword arguments
+        :type counts: int
+        """
+        unknown = set(counts) - set(counters)
+        if len(unknown) > 0:
+            raise ValueError('Unknown counters: {}'.format(', '.join(sorted(unknown))))
+        with self._lock:
+            phase = self.phases.get(name)
+            if phase is None:
+                phase = self.phases[name] = OrderedDict([('seconds', 0.0), ('calls', 0)] + [(c, 0) for c in counters])
+            phase['seconds'] += seconds
+            phase['calls'] += calls
+            for k, v in counts.items():
+                phase[k] += v
+
+    @contextlib.contextmanager
+    def phase(self, name, **counts):
+        """
+        Time a block of code as one call of a phase. The counts may be given here if they are known in advance, or
+        added to the dictionary the ``with`` statement gives once they are known::
+
+            with metrics.phase('download', files=1) as counts:
+                counts['bytes'] = download_file(url, out_name)
+
+        The time is recorded even if the block raises an exception.
+        """
+        counts = dict(counts)
+        t0 = time.time()
+        try:
+            yield counts
+        finally:
+            self.add(name, time.time() - t0, **counts)
+
+    def merge(self, phases):
+        """
+        Add the totals from another run, e.g. one done in a worker process.
+
+        :param phases: the totals, as returned by :meth:`as_dict`
+        :type phases: dict
+        """
+        for name, phase in phases.items():
+            self.add(name, **phase)
+
+    def as_dict(self):
+        with self._lock:
+            return OrderedDict((name, OrderedDict(phase)) for name, phase in self.phases.items())
+
+    def report(self, wall_seconds, **info):
+        """
+        Make the report written by :meth:`write`: the totals for each phase plus its throughput, the run's wall time
+        and peak memory use, and any other information given.
+
+        :param wall_seconds: how long the whole run took
+        :type wall_seconds: float
+
+        :param info: anything else to include in the report, e.g. the options used. Values must be JSON serializable.
+
+        :rtype: dict
+        """
+        phases = self.as_dict()
+        for phase in phases.values():
+            for c in counters:
+                if phase['seconds'] > 0 and phase[c] > 0:
+                    phase[c + '_per_s'] = phase[c] / phase['seconds']
+
+        report = OrderedDict([('command', sys.argv),
+                              ('finished', dt.datetime.now().isoformat()),
+                              ('wall_seconds', wall_seconds)])
+        report.update(peak_memory_mb())
+        report['phases'] = phases
+        report.update(info)
+        return report
+
+    def write(self, filename, wall_seconds, **info):
+        """
+        Write the report from :meth:`report` to a JSON file.
+        """
+        tmp_file = filename + '.tmp'
+        with open(tmp_file, 'w') as fobj:
+            json.dump(self.report(wall_seconds, **info), fobj, indent=2, default=str)
+        _replace(tmp_file, filename)
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS. For child processes (e.g. post-processing commands or
+    # worker processes) it is the largest single child, not the total of all of them.
+    if resource is None:
+        return dict()
+    scale = 1024**2 if sys.platform == 'darwin' else 1024
+    return OrderedDict([('peak_rss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale),
+                        ('peak_child_rss_mb', resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)])
+
+
+_current = PhaseMetrics()
+# The profilers of threads started while profiled() is active, to be merged into its statistics
+_thread_profiles = None
+_profile_lock = threading.Lock()
+
+
+def get_metrics():
+    return _current
+
+
+def phase(name, **counts):
+    return _current.phase(name, **counts)
+
+
+def add(name, seconds=0.0, calls=1, **counts):
+    _current.add(name, seconds=seconds, calls=calls, **counts)
+
+
+@contextlib.contextmanager
+def collecting():
+    """
+    Record to a new :class:`PhaseMetrics` for the duration of the ``with`` block, which it gives, then go back to the
+    previous one. Threads started inside the block record to the new metrics too.
+    """
+    global _current
+    outer = _current
+    _current = PhaseMetrics()
+    try:
+        yield _current
+    finally:
+        _current = outer
+
+
+@contextlib.contextmanager
+def profiled(filename):
+    """
+    Run the ``with`` block under :mod:`cProfile` and save the statistics to a file, which can be read with
+    :mod:`pstats` (``python -m pstats FILE``) or a viewer such as snakeviz. Before Python 3.12, cProfile only sees the
+    thread it is started in, so functions wrapped with :func:`profile_thread` and run in other threads are profiled
+    separately and merged in. Does nothing if ``filename`` is ``None``.
+
+    :param filename: the file to save the statistics to
+    :type filename: str or None
+    """
+    global _thread_profiles
+    if filename is None:
+        yield
+        return
+
+    _thread_profiles = []
+    prof = cProfile.Profile()
+    prof.enable()
+    try:
+        yield
+    finally:
+        prof.disable()
+        with _profile_lock:
+            stats = pstats.Stats(prof)
+            for thread_prof in _thread_profiles:
+                stats.add(thread_prof)
+            _thread_profiles = None
+        stats.dump_stats(filename)
+
+
+def profile_thread(fxn):
+    """
+    Wrap a function to be run in another thread so that, if :func:`profiled` is active, it is profiled too. Otherwise
+    the function is returned unchanged.
+    """
+    # From Python 3.12, cProfile uses sys.monitoring, so the profiler started by profiled() already sees every thread
+    # and a second one cannot be enabled alongside it
+    if _thread_profiles is None or sys.version_info >= (3, 12):
+        return fxn
+
+    @functools.wraps(fxn)
+    def wrapper(*args, **kwargs):
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Another profiling tool is already active, which leaves this thread to it
+            return fxn(*args, **kwargs)
+        try:
+            return fxn(*args, **kwargs)
+        finally:
+            prof.disable()
+            with _profile_lock:
+                if _thread_profiles is not None:
+                    _thread_profiles.append(prof)
+    return wrapper
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Measure how fast :mod:`behrdownloader.dash_interface` lists and downloads files, against the local mock DASH server
+in :mod:`mock_dash`, for different block sizes and numbers of parallel downloads.
+"""
+import argparse
+import datetime as dt
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    from behrdownloader import dash_interface, dash_session
+except ImportError:
+    # Not installed, so use the copy in this repository
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from behrdownloader import dash_interface, dash_session
+
+from mock_dash import MockDashServer
+
+
+def parse_int_list(value):
+    try:
+        return [int(x) for x in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('"{}" is not a comma separated list of integers'.format(value))
+
+
+def stats_delta(server, before):
+    return {k: server.stats[k] - before[k] for k in before}
+
+
+def bench_listing(server, repeats, cache_dir):
+    """
+    Time listing the files in the mock dataset, bypassing the listing cache.
+
+    :return: the time in seconds of each listing and the number of requests each one made
+    :rtype: tuple of list of float and int
+    """
+    times = []
+    before = dict(server.stats)
+    for i in range(repeats):
+        t0 = time.time()
+        dash_interface.get_dash_file_info_from_doi(server.doi, refresh=True, cache_dir=cache_dir)
+        times.append(time.time() - t0)
+    n_requests = (server.stats['listing_requests'] - before['listing_requests']) // repeats
+    return times, n_requests
+
+
+def bench_download(server, file_info, block_size, jobs, work_dir, stream=False, pipeline=False):
+    """
+    Time downloading every file in the mock dataset into an empty directory.
+
+    :return: the time in seconds, the number of bytes downloaded, and how the server's statistics changed
+    :rtype: tuple of float, int, dict
+    """
+    out_dir = tempfile.mkdtemp(dir=work_dir)
+    file_dict = dash_interface.file_urls(file_info)
+    n_bytes = sum(f['size'] for f in file_info.values())
+    start = dt.datetime(2005, 1, 1)
+    end = dt.datetime(2005 + (len(file_info) - 1) // 12, (len(file_info) - 1) % 12 + 1, 1)
+    before = dict(server.stats)
+    t0 = time.time()
+    try:
+        dash_interface.download_and_extract(file_dict, start, end, out_dir=out_dir, stream=stream, pipeline=pipeline,
+                                            jobs=jobs, block_size=block_size, file_info=file_info,
+                                            logging_fxn=lambda *args: None)
+        elapsed = time.time() - t0
+    finally:
+        shutil.rmtree(out_dir)
+    return elapsed, n_bytes, stats_delta(server, before)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark DASH listing and download throughput against a local mock server')
+    parser.add_argument('--files', type=int, default=8, help='Number of monthly archives to serve. Default is %(default)s.')
+    parser.add_argument('--file-size-mb', type=float, default=4, help='Size of each archive in MiB. Default is %(default)s.')
+    parser.add_argument('--page-size', type=int, default=10, help='Files listed per page. Default is %(default)s.')
+    parser.add_argument('--block-sizes', type=parse_int_list, default=[4096, 65536, 2**20],
+                        help='Comma separated block sizes in bytes to try. Default is 4096,65536,1048576.')
+    parser.add_argument('--jobs', type=parse_int_list, default=[1, 2, 4, 8],
+                        help='Comma separated numbers of parallel downloads to try. Default is 1,2,4,8.')
+    parser.add_argument('--stream', action='store_true', help='Extract while downloading (the --stream download option).')
+    parser.add_argument('--pipeline', action='store_true', help='Download and extract different files at the same time (the --pipeline download option).')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Server delay before each response, in milliseconds. Default is %(default)s.')
+    parser.add_argument('--rate-mbps', type=float, default=None, help='Server bandwidth limit per connection, in MB/s. Default is no limit.')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Fraction of requests the server answers with 429.')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Fraction of downloads the server cuts off half way.')
+    parser.add_argument('--listing-repeats', type=int, default=5, help='How many times to time the file listing. Default is %(default)s.')
+    parser.add_argument('--backoff', type=float, default=0.1,
+                        help='Retry backoff factor for the session, in seconds. Default is %(default)s, shorter than '
+                             'the real default so injected failures do not dominate the timings.')
+    parser.add_argument('--json', help='Also write the results to this JSON file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    work_dir = tempfile.mkdtemp(prefix='behr_dl_bench_')
+    results = {'listing': None, 'downloads': []}
+    print('Generating {} files of {} MiB...'.format(args.files, args.file_size_mb))
+    server = MockDashServer(n_files=args.files, file_size=int(args.file_size_mb * 2**20), page_size=args.page_size,
+                            latency=args.latency_ms / 1000,
+                            rate_limit=args.rate_mbps * 1e6 if args.rate_mbps else None,
+                            throttle_rate=args.throttle_rate, retry_after=0, drop_rate=args.drop_rate)
+    old_dash_root = dash_interface.dash_root
+    try:
+        with server:
+            dash_interface.dash_root = server.url
+            dash_session.configure_session(backoff_factor=args.backoff)
+            times, n_requests = bench_listing(server, args.listing_repeats, cache_dir=work_dir)
+            results['listing'] = {'requests': n_requests, 'seconds': times}
+            print('Listing {} files: {} requests, mean {:.1f} ms, min {:.1f} ms'.format(
+                args.files, n_requests, 1000 * sum(times) / len(times), 1000 * min(times)))
+
+            file_info = dash_interface.get_dash_file_info_from_doi(server.doi, refresh=True, cache_dir=work_dir)
+            print('{:>10} {:>5} {:>9} {:>8} {:>10} {:>8}'.format('block', 'jobs', 'time (s)', 'MB/s', 'throttled', 'dropped'))
+            for block_size in args.block_sizes:
+                for jobs in args.jobs:
+                    dash_session.configure_session(backoff_factor=args.backoff,
+                                                   pool_size=max(jobs, dash_session.default_pool_size))
+                    elapsed, n_bytes, stats = bench_download(server, file_info, block_size, jobs, work_dir,
+                                                             stream=args.stream, pipeline=args.pipeline)
+                    results['downloads'].append({'block_size': block_size, 'jobs': jobs, 'seconds': elapsed,
+                                                 'bytes': n_bytes, 'mb_per_s': n_bytes / elapsed / 1e6,
+                                                 'server': stats})
+                    print('{:>10} {:>5} {:>9.2f} {:>8.1f} {:>10} {:>8}'.format(
+                        block_size, jobs, elapsed, n_bytes / elapsed / 1e6, stats['throttled'], stats['dropped']))
+                    sys.stdout.flush()
+    finally:
+        dash_interface.dash_root = old_dash_root
+        shutil.rmtree(work_dir)
+        if args.json is not None:
+            with open(args.json, 'w') as fobj:
+                json.dump(results, fobj, indent=2)
+
+
+if __name__ == '__main__':
+    main()
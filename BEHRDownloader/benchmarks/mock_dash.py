@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+"""
+A local stand-in for the parts of the DASH REST API that :mod:`behrdownloader.dash_interface` uses: the list of
+versions of a dataset, the paginated list of files in a version, and the file downloads. It serves fake BEHR monthly
+.tgz archives held in memory, and can add latency, throttle bandwidth, answer with 429 "Too Many Requests", or drop
+connections part way through a download, to see how the downloader copes without touching the real DASH site.
+
+To use it from Python::
+
+    from mock_dash import MockDashServer
+    from behrdownloader import dash_interface
+
+    with MockDashServer(n_files=6, latency=0.05, drop_rate=0.1) as server:
+        dash_interface.dash_root = server.url
+        file_info = dash_interface.get_dash_file_info_from_doi(server.doi, refresh=True)
+"""
+import argparse
+import datetime as dt
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import json
+import os
+import random
+import re
+import tarfile
+import threading
+import time
+from urllib.parse import unquote, urlsplit, parse_qs
+
+default_doi = 'doi:10.5072/FK2BEHRMOCK'
+default_n_files = 12
+default_file_size = 4 * 2**20
+default_page_size = 10
+
+
+def make_archive(month, size, n_members):
+    """
+    Make a .tgz archive shaped like a BEHR monthly archive, holding one file of random (so incompressible) bytes per
+    day.
+
+    :param month: the month the archive is for
+    :type month: datetime.datetime
+
+    :param size: roughly how large the archive should be, in bytes
+    :type size: int
+
+    :param n_members: how many daily files to put in the archive
+    :type n_members: int
+
+    :return: the archive
+    :rtype: bytes
+    """
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for day in range(1, n_members + 1):
+            data = os.urandom(size // n_members)
+            info = tarfile.TarInfo('OMI_BEHR-DAILY_US_v3-0B_{}{:02d}.hdf'.format(month.strftime('%Y%m'), day))
+            info.size = len(data)
+            info.mtime = time.time()
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class MockDashServer():
+    """
+    A mock DASH server running in a background thread.
+
+    :param n_files: how many monthly archives the dataset has, starting from January 2005.
+    :type n_files: int
+
+    :param file_size: roughly how large each archive is, in bytes.
+    :type file_size: int
+
+    :param page_size: how many files are listed per page. The real DASH API lists 10.
+    :type page_size: int
+
+    :param latency: how long in seconds to wait before answering each request.
+    :type latency: float
+
+    :param rate_limit: optional, the most bytes per second to send on each connection. Default is no limit.
+    :type rate_limit: float or None
+
+    :param throttle_rate: the fraction of requests to answer with 429 Too Many Requests.
+    :type throttle_rate: float
+
+    :param retry_after: the Retry-After time, in seconds, to send with 429 responses.
+    :type retry_after: int
+
+    :param drop_rate: the fraction of downloads to cut off half way through.
+    :type drop_rate: float
+
+    :param range_support: whether to honor Range requests. If ``False``, the whole file is always sent.
+    :type range_support: bool
+
+    :param seed: the seed for choosing which requests to throttle or drop.
+    :type seed: int
+
+    :param host: the address to listen on.
+    :type host: str
+
+    :param port: the port to listen on. The default, 0, picks a free port; the port chosen is in :attr:`url`.
+    :type port: int
+    """
+    def __init__(self, n_files=default_n_files, file_size=default_file_size, page_size=default_page_size, latency=0.0,
+                 rate_limit=None, throttle_rate=0.0, retry_after=1, drop_rate=0.0, range_support=True, seed=0,
+                 host='127.0.0.1', port=0):
+        self.doi = default_doi
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+        self.range_support = range_support
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {'requests': 0, 'listing_requests': 0, 'downloads': 0, 'throttled': 0, 'dropped': 0,
+                      'bytes_sent': 0}
+
+        self.files = []
+        for i in range(n_files):
+            month = dt.datetime(2005 + i // 12, i % 12 + 1, 1)
+            data = make_archive(month, file_size, n_members=3)
+            self.files.append({'path': 'OMI_BEHR-DAILY_US_v3-0B_{}.tgz'.format(month.strftime('%Y%m')),
+                               'data': data,
+                               'digest': hashlib.md5(data).hexdigest()})
+
+        self._httpd = ThreadingHTTPServer((host, port), _MockDashHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.stats[key] += n
+
+    def chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def versions(self):
+        return {'_embedded': {'stash:versions': [
+            {'versionNumber': 1, '_links': {'stash:files': {'href': '/api/versions/1/files'}}},
+            {'versionNumber': 2, '_links': {'stash:files': {'href': '/api/versions/2/files'}}},
+        ]}}
+
+    def files_page(self, version, page):
+        start = (page - 1) * self.page_size
+        files = self.files[start:start + self.page_size] if version == 2 else []
+        links = {'self': {'href': '/api/versions/{}/files?page={}'.format(version, page)}}
+        if version == 2 and start + self.page_size < len(self.files):
+            links['next'] = {'href': '/api/versions/{}/files?page={}'.format(version, page + 1)}
+        return {'_links': links,
+                '_embedded': {'stash:files': [
+                    {'path': f['path'], 'size': len(f['data']), 'digest': f['digest'], 'digestType': 'md5',
+                     '_links': {'stash:download': {'href': '/api/files/{}/download'.format(start + i)}}}
+                    for i, f in enumerate(files)
+                ]}}
+
+
+class _MockDashHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, which otherwise adds a delayed-ACK wait (~40 ms) to every response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_empty(self, status, headers=None):
+        self.send_response(status)
+        for k, v in (headers or dict()).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        mock = self.server.mock
+        mock.count('requests')
+        if mock.latency > 0:
+            time.sleep(mock.latency)
+        if mock.throttle_rate > 0 and mock.chance(mock.throttle_rate):
+            mock.count('throttled')
+            return self._send_empty(429, {'Retry-After': str(mock.retry_after)})
+
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        files_match = re.match(r'/api/versions/(\d+)/files$', path)
+        download_match = re.match(r'/api/files/(\d+)/download$', path)
+        if re.match(r'/api/datasets/.+/versions$', path):
+            mock.count('listing_requests')
+            self._send_json(mock.versions())
+        elif files_match:
+            mock.count('listing_requests')
+            page = int(parse_qs(url.query).get('page', ['1'])[0])
+            self._send_json(mock.files_page(int(files_match.group(1)), page))
+        elif download_match and int(download_match.group(1)) < len(mock.files):
+            self._send_file(mock, mock.files[int(download_match.group(1))]['data'])
+        else:
+            self._send_empty(404)
+
+    def _send_file(self, mock, data):
+        mock.count('downloads')
+        start = 0
+        range_match = re.match(r'bytes=(\d+)-$', self.headers.get('Range', ''))
+        if range_match and mock.range_support:
+            start = int(range_match.group(1))
+            if start >= len(data):
+                return self._send_empty(416, {'Content-Range': 'bytes */{}'.format(len(data))})
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        body = memoryview(data)[start:]
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        # A dropped download sends the first half of the body then closes the connection
+        n_send = len(body)
+        dropped = mock.drop_rate > 0 and mock.chance(mock.drop_rate)
+        if dropped:
+            n_send //= 2
+
+        piece = 2**16
+        t0 = time.time()
+        for offset in range(0, n_send, piece):
+            self.wfile.write(body[offset:min(offset + piece, n_send)])
+            mock.count('bytes_sent', min(piece, n_send - offset))
+            if mock.rate_limit:
+                # Sleep until the time at which the bytes sent so far would have been sent at the rate limit
+                lag = (offset + piece) / mock.rate_limit - (time.time() - t0)
+                if lag > 0:
+                    time.sleep(lag)
+
+        if dropped:
+            mock.count('dropped')
+            self.wfile.flush()
+            self.close_connection = True
+            self.connection.shutdown(2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a local mock of the DASH API serving fake BEHR archives')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on. Default is %(default)s.')
+    parser.add_argument('--files', type=int, default=default_n_files, help='Number of monthly archives. Default is %(default)s.')
+    parser.add_argument('--file-size-mb', type=float, default=default_file_size / 2**20, help='Size of each archive in MiB. Default is %(default)s.')
+    parser.add_argument('--page-size', type=int, default=default_page_size, help='Files listed per page. Default is %(default)s.')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay before answering each request, in milliseconds.')
+    parser.add_argument('--rate-mbps', type=float, default=None, help='Bandwidth limit per connection, in MB/s.')
+    parser.add_argument('--throttle-rate', type=float, default=0, help='Fraction of requests to answer with 429 Too Many Requests.')
+    parser.add_argument('--drop-rate', type=float, default=0, help='Fraction of downloads to cut off half way.')
+    parser.add_argument('--no-range', action='store_true', help='Ignore Range requests and always send whole files.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    server = MockDashServer(n_files=args.files, file_size=int(args.file_size_mb * 2**20), page_size=args.page_size,
+                            latency=args.latency_ms / 1000,
+                            rate_limit=args.rate_mbps * 1e6 if args.rate_mbps else None,
+                            throttle_rate=args.throttle_rate, drop_rate=args.drop_rate,
+                            range_support=not args.no_range, port=args.port)
+    print('Mock DASH serving {} files at {}; dataset DOI {}'.format(len(server.files), server.url, server.doi))
+    print('Set behrdownloader.dash_interface.dash_root = "{}" to use it. Press Ctrl+C to stop.'.format(server.url))
+    server.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import os
+import pstats
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from behrdownloader import metrics
+
+
+def _busy_work(n):
+    return sum(i * i for i in range(n))
+
+
+class TestProfiled(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.prof_file = os.path.join(self.tmp_dir, 'run.prof')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_profile_thread_while_profiled(self):
+        # The worker thread must run (and not fail to start a second profiler) while the main one is active, and
+        # what it did must show up in the saved statistics
+        results = []
+        errors = []
+
+        def worker():
+            try:
+                results.append(metrics.profile_thread(_busy_work)(10000))
+            except Exception as err:
+                errors.append(err)
+
+        with metrics.profiled(self.prof_file):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(results, [_busy_work(10000)])
+        profiled_fxns = set(name for _, _, name in pstats.Stats(self.prof_file).stats)
+        self.assertIn('_busy_work', profiled_fxns)
+
+    def test_profile_thread_with_another_profiler_active(self):
+        # What Python 3.12 and later do when a second profiler is enabled; the function should still run, unprofiled
+        class ActiveProfile(metrics.cProfile.Profile):
+            def enable(self, *args, **kwargs):
+                raise ValueError('Another profiling tool is already active')
+
+        with metrics.profiled(self.prof_file):
+            with mock.patch.object(metrics.cProfile, 'Profile', ActiveProfile):
+                result = metrics.profile_thread(_busy_work)(100)
+        self.assertEqual(result, _busy_work(100))
+
+    def test_profile_thread_unchanged_without_profiler(self):
+        self.assertIs(metrics.profile_thread(_busy_work), _busy_work)
+
+    def test_no_file_without_filename(self):
+        with metrics.profiled(None):
+            _busy_work(10)
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class TestPython2Compatible(unittest.TestCase):
+    # The converter scripts in BEHRWebTools are Python 2 and import this module through metricsBEHR.py. The Python 2
+    # interpreter can be given with the BEHR_PYTHON2 environment variable; without one the test is skipped.
+    def test_imports_in_python2(self):
+        python2 = os.environ.get('BEHR_PYTHON2', 'python2')
+        try:
+            available = subprocess.call([python2, '-c', 'import sys; sys.exit(sys.version_info[0] != 2)']) == 0
+        except OSError:
+            available = False
+        if not available:
+            self.skipTest('no Python 2 interpreter ({}) to test with'.format(python2))
+
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(metrics.__file__)))
+        code = ('import sys; sys.path.append({!r}); from behrdownloader import metrics; '
+                'm = metrics.PhaseMetrics(); m.merge({{"read": {{"seconds": 1.0, "calls": 2, "bytes": 3}}}}); '
+                'm.report(1.0)').format(package_dir)
+        self.assertEqual(subprocess.call([python2, '-c', code]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
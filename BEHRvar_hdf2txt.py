@@ -4,11 +4,30 @@ from __future__ import absolute_import
 from __builtin__ import int
 
 import h5py
+import multiprocessing
+import numpy as np
 import os
 import re
 import sys
+import time
 import argparse
 
+from catalogBEHR import SwathCatalog, parse_bbox
+import metricsBEHR
+
+# pyarrow is only needed for the Parquet and Feather output formats
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+# How many pixels' worth of lines to format and write at once
+default_block_rows = 10000
+
+# Roughly how much memory the values read from one swath at a time may use, in MB
+default_max_memory_mb = 100
+
 class VariableError(ValueError):
     def __init__(self, variables):
         if isinstance(variables, list):
@@ -31,23 +50,42 @@ def shell_error(msg, errorcode=1):
     exit(errorcode)
 
 def get_args():
-    parser = argparse.ArgumentParser(description='Extract a BEHR variable from HDF5 to a CSV file')
+    parser = argparse.ArgumentParser(description='Extract a BEHR variable from HDF5 to a CSV (or binary table) file')
     parser.add_argument('file_in', type=str, help='the .hdf file(s) to extract variables from', nargs='+')
     parser.add_argument('--vars', type=str, action=CreateList, default=['Latitude','Longitude','BEHRColumnAmountNO2Trop'], help='the variable(s) to extract from the listed files')
     parser.add_argument('--out-prefix', type=str, default='', help='the prefix for the output files, default is the same as the input')
     parser.add_argument('--no-merge-vars', action='store_true', help='put output variables in separate files.')
     parser.add_argument('--no-merge-swaths', action='store_true', help='put swaths in separate files.')
-    #parser.add_argument('--merge-days', action='store_true', help='put all files specified into one output. Conflicts with --no-merge-swaths')
+    parser.add_argument('--merge-days', action='store_true', help='put all files specified into one output. Conflicts with --no-merge-swaths')
+    parser.add_argument('--format', choices=['csv', 'parquet', 'feather', 'npz'], default='csv', help='the output file format. parquet and feather require pyarrow. Default is csv.')
+    parser.add_argument('--bbox', type=parse_bbox, default=None, help='only output pixels with centers inside this box, given as lon_min,lon_max,lat_min,lat_max.')
+    parser.add_argument('--reject-flags', type=int, default=None, help='only output pixels where none of these bits are set in the --flag-var variable, e.g. 1 to remove pixels BEHR flags as low quality.')
+    parser.add_argument('--flag-var', type=str, default='BEHRQualityFlags', help='the variable to check against --reject-flags, default is BEHRQualityFlags.')
+    parser.add_argument('--max-memory', type=float, default=default_max_memory_mb, help='roughly how many MB of data to read from a swath at once. Swaths are read in blocks of along-track rows that fit in this. Default is {0}. (npz output still holds all of its data until written.)'.format(default_max_memory_mb))
+    parser.add_argument('--catalog', type=str, default=None, help='a swath catalog made by catalogBEHR.py. With --bbox, files and swaths the catalog shows are outside the box are skipped without reading them.')
+    parser.add_argument('--workers', type=int, default=1, help='the number of files to process at once, in separate processes. Default is 1. Conflicts with --merge-days')
+    parser.add_argument('--metrics-out', type=str, default=None, help='write the time spent and data handled in each phase (HDF5 reads, formatting, writing) to this JSON file')
+    parser.add_argument('--profile', type=str, default=None, help='run under cProfile and save the statistics to this file, for python -m pstats. With --workers, the workers\' statistics are included.')
 
     args = parser.parse_args()
     if args.merge_days and args.no_merge_swaths:
         shell_error('--merge-days and --no-merge-swaths are mutually exclusive')
+    elif args.merge_days and args.workers > 1:
+        shell_error('--merge-days and --workers are mutually exclusive')
+    elif args.workers < 1:
+        shell_error('--workers must be at least 1')
+    elif args.max_memory <= 0:
+        shell_error('--max-memory must be greater than 0')
 
     return args
 
-def outfile_name_parts(args, file_in_name, swath=None, var=None):
+def outfile_name_parts(args, file_in_name, swath=None, var=None, last_file_in_name=None):
     match = re.search('\d\d\d\d\d\d\d\d', file_in_name)
     datestr = match.group()
+    if last_file_in_name is not None:
+        last_datestr = re.search('\d\d\d\d\d\d\d\d', last_file_in_name).group()
+        if last_datestr != datestr:
+            datestr += '-' + last_datestr
     if args.out_prefix == '':
         prefix = file_in_name[:match.start()].rstrip('_')
     else:
@@ -59,7 +97,7 @@ def outfile_name_parts(args, file_in_name, swath=None, var=None):
     if var is not None:
         file_out_name += '_' + var
 
-    file_out_name += '.csv'
+    file_out_name += '.' + args.format
     return file_out_name
 
 def write_header(file_in, file_out, vars):
@@ -70,6 +108,12 @@ def write_header(file_in, file_out, vars):
     elif 'w' not in file_out.mode and 'a' not in file_out.mode:
         raise IOError('file_out must be opened for writing (using w or a)')
 
+    file_out.write(','.join(header_columns(file_in, vars))+'\n')
+
+def header_columns(file_in, vars):
+    if not isinstance(file_in, h5py._hl.files.File):
+        raise TypeError('file_in must be an instance of h5py._hl.files.File, typically returned from h5py.File()')
+
     swath_name = file_in['Data'].keys()[0]
     swath = file_in['Data'][swath_name]
     header = ['AcrossTrackInd', 'AlongTrackInd']
@@ -87,9 +131,47 @@ def write_header(file_in, file_out, vars):
         else:
             raise RuntimeError('{0} dimensional variables not implemented'.format(len(shape)))
 
-    file_out.write(','.join(header)+'\n')
+    return header
+
+def swath_subset(swath, bbox=None, reject_flags=None, flag_var='BEHRQualityFlags'):
+    if not isinstance(swath, h5py._hl.group.Group):
+        raise TypeError('swath must be an instance of h5py._hl.group.Group')
+
+    # Only latitude, longitude, and the flags are read in full; the returned row and column ranges let the other
+    # variables be read as hyperslabs covering just the pixels wanted.
+    shape = swath['Longitude'].shape
+    rows = slice(0, shape[0])
+    cols = slice(0, shape[1])
+    mask = None
+    if bbox is not None:
+        lon = swath['Longitude'][()]
+        lat = swath['Latitude'][()]
+        mask = (lon >= bbox[0]) & (lon <= bbox[1]) & (lat >= bbox[2]) & (lat <= bbox[3])
+        in_rows = np.flatnonzero(mask.any(axis=1))
+        in_cols = np.flatnonzero(mask.any(axis=0))
+        if in_rows.size == 0:
+            return None
+        rows = slice(in_rows[0], in_rows[-1]+1)
+        cols = slice(in_cols[0], in_cols[-1]+1)
+        mask = mask[rows, cols]
+
+    if reject_flags is not None:
+        try:
+            flags = swath[flag_var][rows, cols]
+        except KeyError:
+            shell_error('The flag variable {0} is not present in {1}'.format(flag_var, swath.name))
+        good = (flags.astype(np.int64) & reject_flags) == 0
+        mask = good if mask is None else mask & good
+
+    if mask is not None:
+        if not mask.any():
+            return None
+        elif mask.all():
+            mask = None
+
+    return rows, cols, mask
 
-def write_vars(swath, file_out, vars):
+def write_vars(swath, file_out, vars, block_rows=default_block_rows, subset=None, max_bytes=default_max_memory_mb*1e6):
     if not isinstance(swath, h5py._hl.group.Group):
         raise TypeError('swath must be an instance of h5py._hl.group.Group')
     elif not isinstance(file_out, file):
@@ -97,34 +179,293 @@ def write_vars(swath, file_out, vars):
     elif 'w' not in file_out.mode and 'a' not in file_out.mode:
         raise IOError('file_out must be opened for writing (using w or a)')
 
+    # Write the along and across track indicies first, then each variable. Converting a block of each column to strings
+    # at once formats the values the same way str() does on each element, but without a Python call per value.
+    for row_block in swath_row_blocks(swath, vars, subset=subset, max_bytes=max_bytes):
+        columns = swath_columns(swath, vars, subset=row_block)
+        for start in range(0, len(columns[0]), block_rows):
+            with metricsBEHR.phase('format', pixels=min(block_rows, len(columns[0]) - start)):
+                block = [col[start:start+block_rows].astype(str).tolist() for col in columns]
+                text = ''.join(','.join(line) + '\n' for line in zip(*block))
+            with metricsBEHR.phase('write', bytes=len(text)):
+                file_out.write(text)
+
+def swath_row_blocks(swath, vars, subset=None, max_bytes=default_max_memory_mb*1e6):
+    if not isinstance(swath, h5py._hl.group.Group):
+        raise TypeError('swath must be an instance of h5py._hl.group.Group')
+
+    # Split the rows of a swath (or of a subset from swath_subset) into blocks of along-track rows small enough that
+    # reading every variable for one block stays under max_bytes. 3D variables such as scattering weights are most of
+    # this, since each pixel has a whole profile. Blocks are a whole number of HDF5 chunks tall and start on chunk
+    # boundaries where possible, so each chunk is read (and decompressed) once instead of once per block it spans.
+    if subset is None:
+        shape = swath['Longitude'].shape
+        subset = (slice(0, shape[0]), slice(0, shape[1]), None)
+    rows, cols, mask = subset
+    n_cols = cols.stop - cols.start
+
+    # The along and across track indices take 16 bytes per pixel, and flattening and masking the values read can
+    # copy them once more, hence the factor of 2.
+    row_bytes = 16 * n_cols
+    chunk_rows = 1
+    for v in vars:
+        try:
+            dset = swath[v]
+        except KeyError:
+            shell_error('The variable {0} is not present in {1}'.format(v, swath.name))
+        row_bytes += n_cols * int(np.prod(dset.shape[2:])) * dset.dtype.itemsize
+        if dset.chunks is not None:
+            chunk_rows = max(chunk_rows, dset.chunks[0])
+
+    n_block = max(1, int(max_bytes // (2 * row_bytes)))
+    if n_block >= chunk_rows:
+        n_block -= n_block % chunk_rows
+
+    start = rows.start
+    while start < rows.stop:
+        stop = min(rows.stop, (start // n_block + 1) * n_block)
+        block_mask = mask[start-rows.start:stop-rows.start] if mask is not None else None
+        if block_mask is None or block_mask.any():
+            yield slice(start, stop), cols, block_mask
+        start = stop
+
+def swath_columns(swath, vars, subset=None):
+    if not isinstance(swath, h5py._hl.group.Group):
+        raise TypeError('swath must be an instance of h5py._hl.group.Group')
+
     tst = [isinstance(x,str) for x in vars]
     if not isinstance(vars, list) or not all(tst):
         raise TypeError('vars must be a list of strings')
 
-    # Write the along and across track indicies first, then each variable
-    shape = swath['Longitude'].shape
-    for i in range(shape[0]):
-        for j in range(shape[1]):
-            line = [str(i),str(j)]
-            for v in vars:
-                if len(swath[v].shape) == 3:
-                    vals = swath[v][i, j, :]
+    # Read each variable in one go, so that there is one HDF5 read per variable rather than one per pixel, and flatten
+    # it into one column per value written for each pixel. 3D variables give one column per level. If only a subset of
+    # the swath is wanted (from swath_subset), only the block of rows and columns containing it is read, and the
+    # pixels in that block outside the subset are dropped.
+    if subset is None:
+        shape = swath['Longitude'].shape
+        subset = (slice(0, shape[0]), slice(0, shape[1]), None)
+    rows, cols, mask = subset
+    n_rows = rows.stop - rows.start
+    n_cols = cols.stop - cols.start
+    n_pixels = n_rows * n_cols
+    keep = mask.reshape(n_pixels) if mask is not None else slice(None)
+
+    with metricsBEHR.phase('read') as counts:
+        columns = [np.repeat(np.arange(rows.start, rows.stop), n_cols)[keep],
+                   np.tile(np.arange(cols.start, cols.stop), n_rows)[keep]]
+        counts['pixels'] = len(columns[0])
+        counts['bytes'] = 0
+        for v in vars:
+            vals = swath[v][rows, cols]
+            counts['bytes'] += vals.nbytes
+            if vals.ndim == 3:
+                vals = vals.reshape(n_pixels, vals.shape[2])[keep]
+                columns.extend(vals[:, k] for k in range(vals.shape[1]))
+            else:
+                columns.append(vals.reshape(n_pixels)[keep])
+
+    return columns
+
+class CsvOutput(object):
+    def __init__(self, filename, file_in, vars, max_bytes=default_max_memory_mb*1e6):
+        self.vars = vars
+        self.max_bytes = max_bytes
+        self.file_out = open(filename, 'w')
+        write_header(file_in, self.file_out, vars)
+
+    def write_swath(self, swath, subset=None):
+        write_vars(swath, self.file_out, self.vars, subset=subset, max_bytes=self.max_bytes)
+
+    def close(self):
+        self.file_out.close()
+
+class ArrowOutput(object):
+    # Each block of rows is written as soon as it is read, as a row group in Parquet files or a record batch in Feather
+    # files, so merged outputs never need to be held in memory.
+    def __init__(self, filename, file_in, vars, format, max_bytes=default_max_memory_mb*1e6):
+        if pa is None:
+            shell_error('pyarrow is required to write {0} files'.format(format))
+        self.filename = filename
+        self.vars = vars
+        self.format = format
+        self.max_bytes = max_bytes
+        self.names = header_columns(file_in, vars)
+        self.writer = None
+
+    def write_swath(self, swath, subset=None):
+        for row_block in swath_row_blocks(swath, self.vars, subset=subset, max_bytes=self.max_bytes):
+            columns = swath_columns(swath, self.vars, subset=row_block)
+            with metricsBEHR.phase('format', pixels=len(columns[0])):
+                table = pa.Table.from_arrays(columns, names=self.names)
+            with metricsBEHR.phase('write', bytes=table.nbytes):
+                if self.writer is None:
+                    if self.format == 'parquet':
+                        self.writer = pq.ParquetWriter(self.filename, table.schema)
+                    else:
+                        self.writer = pa.ipc.new_file(self.filename, table.schema)
+                self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class NpzOutput(object):
+    # .npz files can't be appended to, so the columns are collected until the output is closed
+    def __init__(self, filename, file_in, vars, max_bytes=default_max_memory_mb*1e6):
+        self.filename = filename
+        self.vars = vars
+        self.max_bytes = max_bytes
+        self.names = header_columns(file_in, vars)
+        self.columns = [[] for n in self.names]
+
+    def write_swath(self, swath, subset=None):
+        for row_block in swath_row_blocks(swath, self.vars, subset=subset, max_bytes=self.max_bytes):
+            for col, vals in zip(self.columns, swath_columns(swath, self.vars, subset=row_block)):
+                col.append(vals)
+
+    def close(self):
+        with metricsBEHR.phase('write') as counts:
+            np.savez(self.filename, **dict((n, np.concatenate(col)) for n, col in zip(self.names, self.columns)))
+            counts['bytes'] = os.path.getsize(self.filename)
+
+def open_output(filename, file_in, vars, format, max_bytes=default_max_memory_mb*1e6):
+    if format == 'csv':
+        return CsvOutput(filename, file_in, vars, max_bytes=max_bytes)
+    elif format in ('parquet', 'feather'):
+        return ArrowOutput(filename, file_in, vars, format, max_bytes=max_bytes)
+    elif format == 'npz':
+        return NpzOutput(filename, file_in, vars, max_bytes=max_bytes)
+    else:
+        raise ValueError('Output format "{0}" not recognized'.format(format))
+
+def extract_files(args, files_in, file_swaths=None):
+    if args.no_merge_vars:
+        var_groups = [[v] for v in args.vars]
+    else:
+        var_groups = [args.vars]
+
+    # Output files stay open until everything that goes in them has been written, so that each swath can be written
+    # as soon as it is read and only one swath needs to be held in memory at a time.
+    files_out = dict()
+    try:
+        for f in files_in:
+            # file_swaths optionally gives the swaths to read from each file, from the catalog. None means read them all.
+            swaths = file_swaths.get(f) if file_swaths is not None else None
+            if swaths is not None and len(swaths) == 0:
+                continue
+
+            t0 = time.time()
+            h5f = h5py.File(f, 'r')
+            for swath in (swaths if swaths is not None else h5f['Data']):
+                if args.bbox is not None or args.reject_flags is not None:
+                    with metricsBEHR.phase('subset'):
+                        subset = swath_subset(h5f['Data'][swath], bbox=args.bbox, reject_flags=args.reject_flags, flag_var=args.flag_var)
+                    if subset is None:
+                        # No pixels in this swath are wanted
+                        continue
                 else:
-                    vals = swath[v][i, j]
+                    subset = None
+
+                for vars in var_groups:
+                    var = vars[0] if args.no_merge_vars else None
+                    if args.merge_days:
+                        file_out_name = outfile_name_parts(args, files_in[0], var=var, last_file_in_name=files_in[-1])
+                    elif args.no_merge_swaths:
+                        file_out_name = outfile_name_parts(args, f, swath=swath, var=var)
+                    else:
+                        file_out_name = outfile_name_parts(args, f, var=var)
+
+                    if file_out_name not in files_out:
+                        files_out[file_out_name] = open_output(file_out_name, h5f, vars, args.format, max_bytes=args.max_memory*1e6)
+                    files_out[file_out_name].write_swath(h5f['Data'][swath], subset=subset)
+
+                if args.no_merge_swaths:
+                    for fout in files_out.values():
+                        fout.close()
+                    files_out.clear()
+
+            h5f.close()
+            if not args.merge_days:
+                for fout in files_out.values():
+                    fout.close()
+                files_out.clear()
+            # The whole time spent on each input file, including the phases above, and the input data rate
+            metricsBEHR.add('file', time.time() - t0, files=1, bytes=os.path.getsize(f))
+    finally:
+        for fout in files_out.values():
+            fout.close()
+
+def extract_file_task(task):
+    # Run in the worker processes, so catch everything (including the SystemExit from shell_error) and report it
+    # rather than letting one bad file take down the batch.
+    # The metrics for the file are returned with the result so that the main process can add them up; a worker
+    # process's statistics are saved for main to merge if profiling.
+    args, file_in, file_swaths, worker_profile = task
+    profile = metricsBEHR.worker_profile_name(worker_profile)
+    err = None
+    with metricsBEHR.collecting() as metrics, metricsBEHR.profiled(profile):
+        try:
+            extract_files(args, [file_in], file_swaths=file_swaths)
+        except (Exception, SystemExit) as e:
+            err = '{0}: {1}'.format(type(e).__name__, e)
+    return file_in, err, metrics.as_dict()
+
+def print_summary(results):
+    failures = [(f, err) for f, err in results if err is not None]
+    print('{0} of {1} files processed successfully'.format(len(results) - len(failures), len(results)))
+    for f, err in failures:
+        print('  FAILED {0}: {1}'.format(f, err), file=sys.stderr)
+    return len(failures)
+
+def catalog_swaths(args):
+    # Look up which swaths of each file overlap the bounding box once, here, rather than loading the catalog in every
+    # worker process. Files that are not in the catalog (or have changed since) map to None and are checked directly.
+    if args.catalog is None or args.bbox is None:
+        return dict()
+    with metricsBEHR.phase('catalog'):
+        catalog = SwathCatalog(args.catalog)
+        return dict((f, catalog.swaths_overlapping(f, args.bbox)) for f in args.file_in)
+
+def run(args):
+    # Returns the number of files that could not be processed
+    file_swaths = catalog_swaths(args)
+    if args.merge_days:
+        # Everything goes into one output, so there's nothing to split between processes
+        extract_files(args, args.file_in, file_swaths=file_swaths)
+        return 0
 
-                for val in vals:
-                    line.append(str(val))
+    # Each input file produces its own outputs, so files can be processed independently and in any order
+    # Files processed in this process are already covered by the main profile
+    worker_profile = metricsBEHR.worker_profile_prefix(args.profile) if args.workers > 1 else None
+    tasks = [(args, f, {f: file_swaths.get(f)}, worker_profile) for f in args.file_in]
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        try:
+            results = pool.map(extract_file_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [extract_file_task(t) for t in tasks]
 
-            file_out.write(','.join(line) + '\n')
+    for f, err, phases in results:
+        metricsBEHR.get_metrics().merge(phases)
+    return print_summary([(f, err) for f, err, phases in results])
 
 def main():
     args = get_args()
-    for f in args.file_in:
-        h5f = h5py.File(f)
-        for swath in h5f['Data']:
-            if args.no_merge_swaths or swath == h5f['Data'].keys()[0]:
-                if args.no_merge_swaths:
-                write_header(h5f, )
+    t0 = time.time()
+    with metricsBEHR.collecting() as metrics:
+        with metricsBEHR.profiled(args.profile):
+            n_failed = run(args)
+
+    if args.profile is not None:
+        metricsBEHR.merge_worker_profiles(args.profile)
+    if args.metrics_out is not None:
+        metrics.write(args.metrics_out, time.time() - t0, files_in=len(args.file_in), failed=n_failed,
+                      vars=args.vars, format=args.format, workers=args.workers)
+    if n_failed > 0:
+        exit(1)
 
 
 if __name__ == "__main__":
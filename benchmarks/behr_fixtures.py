@@ -0,0 +1,118 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import argparse
+import h5py
+import numpy as np
+
+# OMI has 60 across-track pixels, and a full orbit is about 1644 along-track rows. BEHR files have about 14 swaths
+# per day and the profile variables are given on 30 pressure levels.
+n_across = 60
+n_along_orbit = 1644
+n_levels = 30
+fill_value = -1.267651e30
+
+# Named fixture sizes: (number of swaths, along-track rows per swath)
+sizes = {'small': (2, 300),
+         'medium': (6, 1000),
+         'large': (14, n_along_orbit)}
+
+def make_behr_file(filename, n_swaths, n_along, n_levels=n_levels, fill_fraction=0.02, chunks=None, compression=None, seed=0):
+    """
+    Write a file shaped like a BEHR HDF version 5 file, with the same /Data/SwathNNNNN layout and the variables the
+    converters use most, filled with plausible random values.
+
+    :param filename: the file to write
+    :type filename: str
+
+    :param n_swaths: how many swaths to write
+    :type n_swaths: int
+
+    :param n_along: the number of along-track rows in each swath
+    :type n_along: int
+
+    :param n_levels: the number of pressure levels of the 3D profile variables
+    :type n_levels: int
+
+    :param fill_fraction: the fraction of pixels to set to the fill value in the data variables
+    :type fill_fraction: float
+
+    :param chunks: optional, the number of along-track rows per HDF5 chunk. If not given, the datasets are contiguous.
+    :type chunks: int
+
+    :param compression: optional, the compression filter to use, e.g. "gzip". Requires ``chunks``.
+    :type compression: str
+
+    :param seed: the random number seed, so the same arguments always give the same file
+    :type seed: int
+
+    :return: the number of pixels written
+    :rtype: int
+    """
+    rng = np.random.RandomState(seed)
+    pressures = np.linspace(1020, 200, n_levels).astype(np.float32)
+
+    def create(group, name, data, **attrs):
+        kwargs = dict()
+        if chunks is not None:
+            kwargs['chunks'] = (min(chunks, data.shape[0]),) + data.shape[1:]
+            kwargs['compression'] = compression
+        dset = group.create_dataset(name, data=data, **kwargs)
+        for k, v in attrs.items():
+            dset.attrs[k] = v
+
+    with h5py.File(filename, 'w') as f:
+        for s in range(n_swaths):
+            g = f.create_group('/Data/Swath{0:05d}'.format(10000 + s))
+
+            # Each orbit is ~25 degrees of longitude west of the last, wrapping around into [-180, 180) as real
+            # geolocation does; along track runs south to north
+            along = np.linspace(0, 1, n_along)[:, np.newaxis]
+            across = np.linspace(-1, 1, n_across)[np.newaxis, :]
+            lat = 15 + 40 * along + 2 * across ** 2
+            lon = (-60 - 25 * s - 14 * across - 5 * along + 180) % 360 - 180
+            create(g, 'Latitude', lat.astype(np.float32), Unit='deg')
+            create(g, 'Longitude', lon.astype(np.float32), Unit='deg')
+
+            no2 = rng.lognormal(np.log(2e15), 0.7, (n_along, n_across)).astype(np.float32)
+            no2[rng.random_sample(no2.shape) < fill_fraction] = fill_value
+            create(g, 'BEHRColumnAmountNO2Trop', no2, Unit='molec./cm^2', _FillValue=np.float32(fill_value))
+            create(g, 'ColumnAmountNO2Trop', (no2 * rng.uniform(0.8, 1.2, no2.shape)).astype(np.float32),
+                   Unit='molec./cm^2', _FillValue=np.float32(fill_value))
+            create(g, 'BEHRQualityFlags', rng.randint(0, 4, (n_along, n_across)).astype(np.uint32))
+            create(g, 'CloudFraction', rng.random_sample((n_along, n_across)).astype(np.float32), _FillValue=np.float32(fill_value))
+
+            profile_shape = (n_along, n_across, n_levels)
+            create(g, 'BEHRPressureLevels', np.broadcast_to(pressures, profile_shape).astype(np.float32), Unit='hPa',
+                   _FillValue=np.float32(fill_value))
+            sw = np.linspace(0.3, 1.5, n_levels)[np.newaxis, np.newaxis, :] * rng.uniform(0.9, 1.1, profile_shape)
+            create(g, 'BEHRScatteringWeightsClear', sw.astype(np.float32), _FillValue=np.float32(fill_value))
+            create(g, 'BEHRAvgKernelsClear', (sw / 1.2).astype(np.float32), _FillValue=np.float32(fill_value))
+            create(g, 'BEHRNO2apriori', rng.lognormal(np.log(1e-9), 1, profile_shape).astype(np.float32),
+                   Unit='parts-per-part', _FillValue=np.float32(fill_value))
+
+    return n_swaths * n_along * n_across
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic BEHR-shaped HDF5 file for testing and benchmarking')
+    parser.add_argument('filename', type=str, help='the file to write. Include a yyyymmdd date in the name (e.g. OMI_BEHR_v3-0B_20050101.hdf) for the converters to use it.')
+    parser.add_argument('--size', choices=sorted(sizes), default=None, help='a named size: {0}'.format(', '.join('{0} ({1} swaths x {2} rows)'.format(k, *sizes[k]) for k in sorted(sizes))))
+    parser.add_argument('--swaths', type=int, default=14, help='the number of swaths, default is 14. Ignored if --size is given.')
+    parser.add_argument('--rows', type=int, default=n_along_orbit, help='the number of along-track rows per swath, default is {0}. Ignored if --size is given.'.format(n_along_orbit))
+    parser.add_argument('--levels', type=int, default=n_levels, help='the number of levels in profile variables, default is {0}'.format(n_levels))
+    parser.add_argument('--chunks', type=int, default=None, help='store the datasets in chunks of this many along-track rows')
+    parser.add_argument('--compression', choices=['gzip', 'lzf'], default=None, help='compress the datasets, requires --chunks')
+    parser.add_argument('--seed', type=int, default=0, help='the random number seed')
+    args = parser.parse_args()
+    if args.compression is not None and args.chunks is None:
+        parser.error('--compression requires --chunks')
+
+    n_swaths, n_along = sizes[args.size] if args.size is not None else (args.swaths, args.rows)
+    n_pixels = make_behr_file(args.filename, n_swaths, n_along, n_levels=args.levels, chunks=args.chunks,
+                              compression=args.compression, seed=args.seed)
+    print('Wrote {0} pixels to {1}'.format(n_pixels, args.filename))
+
+
+if __name__ == '__main__':
+    main()
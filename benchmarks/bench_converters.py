@@ -0,0 +1,165 @@
+"""
+Time the conversion tools (BEHRvar_hdf2txt.py, splitBEHR.py and gridBEHR.py) on synthetic BEHR files of different
+sizes. Each tool is run as a separate process, exactly as from the command line, so that its peak memory use can be
+measured on its own.
+"""
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from behr_fixtures import make_behr_file, sizes
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+profile_vars = 'Latitude,Longitude,BEHRColumnAmountNO2Trop,BEHRScatteringWeightsClear,BEHRPressureLevels'
+default_bbox = '-125,-65,25,50'
+
+def benchmark_cases(fixture, out_prefix, have_pyarrow):
+    # Each case is (name, script, arguments). The split cases write next to the input file; their output is removed
+    # after each run.
+    cases = [('extract csv', 'BEHRvar_hdf2txt.py', ['--out-prefix', out_prefix, fixture]),
+             ('extract csv profiles', 'BEHRvar_hdf2txt.py', ['--vars', profile_vars, '--out-prefix', out_prefix, fixture]),
+             ('extract csv bbox+flags', 'BEHRvar_hdf2txt.py', ['--bbox=' + default_bbox, '--reject-flags', '1', '--out-prefix', out_prefix, fixture]),
+             ('extract npz profiles', 'BEHRvar_hdf2txt.py', ['--vars', profile_vars, '--format', 'npz', '--out-prefix', out_prefix, fixture])]
+    if have_pyarrow:
+        cases += [('extract parquet profiles', 'BEHRvar_hdf2txt.py', ['--vars', profile_vars, '--format', 'parquet', '--out-prefix', out_prefix, fixture]),
+                  ('extract feather profiles', 'BEHRvar_hdf2txt.py', ['--vars', profile_vars, '--format', 'feather', '--out-prefix', out_prefix, fixture])]
+    cases += [('split copy', 'splitBEHR.py', [fixture]),
+              ('split link', 'splitBEHR.py', ['--link', fixture]),
+              ('split virtual', 'splitBEHR.py', ['--virtual', fixture]),
+              ('split chunked gzip', 'splitBEHR.py', ['--chunk-rows', '50', '--compression', 'gzip', '--shuffle', fixture]),
+              ('grid', 'gridBEHR.py', ['--out-prefix', out_prefix, fixture])]
+    return cases
+
+def peak_rss_mb(rusage):
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss / 1024**2
+    return rusage.ru_maxrss / 1024
+
+def run_case(python, script, script_args, log_file):
+    """
+    Run one of the tools and measure it.
+
+    :param python: the Python interpreter to run the tool with
+    :type python: str
+
+    :param script: the file name of the tool, relative to the repository root
+    :type script: str
+
+    :param script_args: the command line arguments to give the tool
+    :type script_args: list of str
+
+    :param log_file: an open file to send the tool's output to
+    :type log_file: file
+
+    :return: the wall time in seconds and the peak resident memory in MB
+    :rtype: tuple of float
+    """
+    t0 = time.time()
+    proc = subprocess.Popen([python, os.path.join(repo_dir, script)] + script_args, stdout=log_file, stderr=log_file)
+    # os.wait4 gives the resource usage of just this process, where getrusage(RUSAGE_CHILDREN) would give the maximum
+    # over every process run so far.
+    _, status, rusage = os.wait4(proc.pid, 0)
+    elapsed = time.time() - t0
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+    if proc.returncode != 0:
+        raise RuntimeError('{0} exited with status {1}'.format(script, proc.returncode))
+    return elapsed, peak_rss_mb(rusage)
+
+def clean_outputs(work_dir, fixture):
+    keep = os.path.basename(fixture)
+    for f in glob.glob(os.path.join(work_dir, '*')):
+        if os.path.basename(f) != keep and os.path.isfile(f):
+            os.remove(f)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Benchmark the BEHR conversion tools on synthetic files')
+    parser.add_argument('--sizes', type=str, default='small,medium', help='comma separated fixture sizes to run: {0}. Default is small,medium.'.format(', '.join('{0} ({1} swaths x {2} rows)'.format(k, *sizes[k]) for k in sorted(sizes))))
+    parser.add_argument('--only', type=str, default=None, help='only run cases whose names start with one of these comma separated prefixes, e.g. "extract,split copy"')
+    parser.add_argument('--repeat', type=int, default=1, help='run each case this many times and report the fastest. Default is 1.')
+    parser.add_argument('--compression', choices=['gzip', 'lzf'], default=None, help='compress the fixture files (chunked 100 rows at a time), as real BEHR files are')
+    parser.add_argument('--python', type=str, default='python2', help='the Python interpreter to run the tools with. The tools need Python 2, so the default is python2.')
+    parser.add_argument('--work-dir', type=str, default=None, help='where to write fixtures and outputs. Default is a temporary directory, removed afterwards.')
+    parser.add_argument('--json', type=str, default=None, help='also write the results to this JSON file')
+
+    args = parser.parse_args()
+    args.sizes = args.sizes.split(',')
+    for size in args.sizes:
+        if size not in sizes:
+            parser.error('Unknown size "{0}"'.format(size))
+    args.only = args.only.split(',') if args.only is not None else None
+    if args.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    return args
+
+def main():
+    args = get_args()
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='behr_bench_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        have_pyarrow = subprocess.call([args.python, '-c', 'import pyarrow'], stderr=open(os.devnull, 'w')) == 0
+    except OSError as err:
+        print('Cannot run {0} ({1}); give a Python 2 interpreter with --python'.format(args.python, err), file=sys.stderr)
+        exit(1)
+    if not have_pyarrow:
+        print('pyarrow is not installed for {0}, skipping parquet and feather'.format(args.python), file=sys.stderr)
+
+    results = []
+    print('{0:<8} {1:<26} {2:>9} {3:>10} {4:>12} {5:>10}'.format('size', 'case', 'pixels', 'time (s)', 'Mpixels/s', 'peak MB'))
+    try:
+        for size in args.sizes:
+            n_swaths, n_along = sizes[size]
+            size_dir = os.path.join(work_dir, size)
+            if not os.path.isdir(size_dir):
+                os.makedirs(size_dir)
+            fixture = os.path.join(size_dir, 'OMI_BEHR_v3-0B_20050101.hdf')
+            n_pixels = make_behr_file(fixture, n_swaths, n_along, chunks=100 if args.compression else None,
+                                      compression=args.compression)
+
+            for name, script, script_args in benchmark_cases(fixture, os.path.join(size_dir, 'out'), have_pyarrow):
+                if args.only is not None and not any(name.startswith(p) for p in args.only):
+                    continue
+                times = []
+                rss = []
+                with open(os.path.join(work_dir, 'bench.log'), 'a') as log_file:
+                    try:
+                        for i in range(args.repeat):
+                            t, m = run_case(args.python, script, script_args, log_file)
+                            times.append(t)
+                            rss.append(m)
+                            clean_outputs(size_dir, fixture)
+                    except RuntimeError as err:
+                        # One broken case shouldn't lose the rest of the run; the tool's output is in bench.log
+                        clean_outputs(size_dir, fixture)
+                        results.append({'size': size, 'case': name, 'pixels': n_pixels, 'error': str(err)})
+                        print('{0:<8} {1:<26} FAILED: {2}'.format(size, name, err))
+                        sys.stdout.flush()
+                        continue
+
+                result = {'size': size, 'case': name, 'pixels': n_pixels, 'fixture_bytes': os.path.getsize(fixture),
+                          'seconds': min(times), 'pixels_per_s': n_pixels / min(times), 'peak_rss_mb': max(rss)}
+                results.append(result)
+                print('{size:<8} {case:<26} {pixels:>9} {seconds:>10.2f} {0:>12.3f} {peak_rss_mb:>10.0f}'.format(
+                    result['pixels_per_s'] / 1e6, **result))
+                sys.stdout.flush()
+    finally:
+        if args.json is not None:
+            with open(args.json, 'w') as fobj:
+                json.dump(results, fobj, indent=2)
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
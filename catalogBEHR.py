@@ -0,0 +1,232 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import argparse
+import fnmatch
+import h5py
+import json
+import numpy as np
+import os
+import re
+import sys
+
+default_catalog_name = '.behr_catalog.json'
+default_pattern = 'OMI_BEHR*.hdf'
+
+# Python 2 has no os.replace, but os.rename does the same thing everywhere except Windows
+_replace = getattr(os, 'replace', os.rename)
+
+def parse_bbox(value):
+    try:
+        bbox = [float(x) for x in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('the bounding box must be four numbers')
+    if len(bbox) != 4:
+        raise argparse.ArgumentTypeError('the bounding box must be four numbers: lon_min,lon_max,lat_min,lat_max')
+    elif bbox[0] > bbox[1] or bbox[2] > bbox[3]:
+        raise argparse.ArgumentTypeError('the bounding box minimums must be less than the maximums')
+    return bbox
+
+def swath_bbox(swath):
+    # Fill values and NaNs are outside any valid latitude or longitude, so only values within the valid range count
+    lon = swath['Longitude'][()]
+    lat = swath['Latitude'][()]
+    good = np.isfinite(lon) & np.isfinite(lat) & (np.abs(lon) <= 180) & (np.abs(lat) <= 90)
+    if not good.any():
+        return None
+    return [float(lon[good].min()), float(lon[good].max()), float(lat[good].min()), float(lat[good].max())]
+
+def bbox_overlaps(swath_box, bbox):
+    if swath_box is None:
+        return False
+    return not (swath_box[1] < bbox[0] or swath_box[0] > bbox[1] or swath_box[3] < bbox[2] or swath_box[2] > bbox[3])
+
+def scan_file(filename):
+    match = re.search('\d\d\d\d\d\d\d\d', os.path.basename(filename))
+    entry = {'size': os.path.getsize(filename),
+             'mtime': os.path.getmtime(filename),
+             'date': match.group() if match is not None else None,
+             'swaths': dict()}
+    with h5py.File(filename, 'r') as f:
+        for name, swath in f['Data'].items():
+            shape = swath['Longitude'].shape
+            entry['swaths'][name] = {'bbox': swath_bbox(swath),
+                                     'shape': list(shape),
+                                     'n_pixels': int(np.prod(shape)),
+                                     'vars': sorted(swath.keys())}
+    return entry
+
+class SwathCatalog(object):
+    """
+    An index of the swaths in a local archive of BEHR .hdf files: for each swath, the bounding box of its pixel
+    centers, its shape and number of pixels, and the variables it contains. Looking a file up in the catalog avoids
+    opening it just to find out whether any of its swaths are of interest.
+
+    The catalog is a JSON file. File names in it are relative to the directory the catalog is in, so an archive can
+    be moved along with its catalog. An entry is only trusted while the file's size and modification time match what
+    was recorded.
+
+    :param path: the catalog file. It is created by :meth:`update` and :meth:`save` if it does not exist.
+    :type path: str
+    """
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.files = self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return dict()
+        with open(self.path) as fobj:
+            return json.load(fobj)['files']
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fobj:
+            json.dump({'files': self.files}, fobj, sort_keys=True)
+        _replace(tmp_path, self.path)
+
+    def _key(self, filename):
+        return os.path.relpath(os.path.abspath(filename), self.directory)
+
+    def _is_current(self, filename, entry):
+        return os.path.isfile(filename) and entry['size'] == os.path.getsize(filename) and \
+            entry['mtime'] == os.path.getmtime(filename)
+
+    def update(self, root_dirs, pattern=default_pattern, verbose=False):
+        """
+        Add new and changed files under one or more directories to the catalog and drop files that no longer
+        exist, then save it. Only files that are new or whose size or modification time changed are opened.
+
+        :param root_dirs: the directories to search, recursively
+        :type root_dirs: str or list of str
+
+        :param pattern: a glob pattern the file names must match
+        :type pattern: str
+
+        :param verbose: print each file as it is scanned
+        :type verbose: bool
+
+        :return: the number of files added or rescanned and the number removed
+        :rtype: tuple of int
+        """
+        if isinstance(root_dirs, str):
+            root_dirs = [root_dirs]
+
+        n_scanned = 0
+        seen = set()
+        for root_dir in root_dirs:
+            for dirpath, dirnames, filenames in os.walk(root_dir):
+                for fname in fnmatch.filter(filenames, pattern):
+                    filename = os.path.join(dirpath, fname)
+                    key = self._key(filename)
+                    seen.add(key)
+                    entry = self.files.get(key)
+                    if entry is not None and self._is_current(filename, entry):
+                        continue
+                    if verbose:
+                        print('Scanning {0}'.format(filename))
+                    self.files[key] = scan_file(filename)
+                    n_scanned += 1
+
+        # Only forget files under the directories that were searched, in case other parts of the archive are on a
+        # disk that is not mounted right now
+        roots = [self._key(d) for d in root_dirs]
+        removed = [k for k in self.files if k not in seen and
+                   any(r == os.curdir or k == r or k.startswith(r + os.sep) for r in roots)]
+        for k in removed:
+            del self.files[k]
+
+        self.save()
+        return n_scanned, len(removed)
+
+    def lookup(self, filename):
+        """
+        Get the catalog entry for a file.
+
+        :param filename: the path to the file
+        :type filename: str
+
+        :return: the entry, a dictionary with the keys "size", "mtime", "date" and "swaths", or ``None`` if the file
+            is not in the catalog or has changed since it was cataloged.
+        :rtype: dict or None
+        """
+        entry = self.files.get(self._key(filename))
+        if entry is None or not self._is_current(filename, entry):
+            return None
+        return entry
+
+    def swaths_overlapping(self, filename, bbox):
+        """
+        List the swaths in a file whose pixels overlap a bounding box.
+
+        :param filename: the path to the file
+        :type filename: str
+
+        :param bbox: the bounding box, as [lon_min, lon_max, lat_min, lat_max]
+        :type bbox: list of float
+
+        :return: the names of the swaths that overlap the box, or ``None`` if the file is not in the catalog or has
+            changed, meaning the file itself must be checked.
+        :rtype: list of str or None
+        """
+        entry = self.lookup(filename)
+        if entry is None:
+            return None
+        return sorted(name for name, info in entry['swaths'].items() if bbox_overlaps(info['bbox'], bbox))
+
+    def query(self, bbox=None, start=None, end=None):
+        """
+        Find the swaths in the catalog that overlap a bounding box and/or fall within a range of dates.
+
+        :param bbox: optional, the bounding box, as [lon_min, lon_max, lat_min, lat_max]
+        :type bbox: list of float
+
+        :param start: optional, the first date to include, as a yyyymmdd string
+        :type start: str
+
+        :param end: optional, the last date to include, as a yyyymmdd string
+        :type end: str
+
+        :return: the matching (file path, swath name) pairs, sorted
+        :rtype: list of tuple
+        """
+        matches = []
+        for key, entry in self.files.items():
+            if (start is not None or end is not None) and entry['date'] is None:
+                continue
+            if start is not None and entry['date'] < start:
+                continue
+            if end is not None and entry['date'] > end:
+                continue
+            for name, info in entry['swaths'].items():
+                if bbox is None or bbox_overlaps(info['bbox'], bbox):
+                    matches.append((os.path.join(self.directory, key), name))
+        return sorted(matches)
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Build or update an index of the swaths in a local archive of BEHR .hdf files, and query it')
+    parser.add_argument('dirs', type=str, nargs='*', help='the directories to search for BEHR files. If none are given, the catalog is only queried.')
+    parser.add_argument('--catalog', type=str, default=default_catalog_name, help='the catalog file, default is {0} in the current directory'.format(default_catalog_name))
+    parser.add_argument('--pattern', type=str, default=default_pattern, help='only catalog files matching this glob pattern, default is {0}'.format(default_pattern))
+    parser.add_argument('--bbox', type=parse_bbox, default=None, help='list the swaths overlapping this box, given as lon_min,lon_max,lat_min,lat_max.')
+    parser.add_argument('--start', type=str, default=None, help='list the swaths on or after this date (yyyymmdd)')
+    parser.add_argument('--end', type=str, default=None, help='list the swaths on or before this date (yyyymmdd)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print each file as it is scanned')
+    return parser.parse_args()
+
+def main():
+    args = get_args()
+    catalog = SwathCatalog(args.catalog)
+    if len(args.dirs) > 0:
+        n_scanned, n_removed = catalog.update(args.dirs, pattern=args.pattern, verbose=args.verbose)
+        print('{0} files scanned, {1} removed, {2} files in {3}'.format(n_scanned, n_removed, len(catalog.files), args.catalog), file=sys.stderr)
+
+    if args.bbox is not None or args.start is not None or args.end is not None:
+        for filename, swath in catalog.query(bbox=args.bbox, start=args.start, end=args.end):
+            print('{0} {1}'.format(filename, swath))
+
+
+if __name__ == "__main__":
+    main()
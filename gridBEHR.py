@@ -0,0 +1,194 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+from __builtin__ import int
+
+import h5py
+import numpy as np
+import os
+import re
+import argparse
+
+from BEHRvar_hdf2txt import CreateList, shell_error, swath_subset
+
+no2_var = 'BEHRColumnAmountNO2Trop'
+
+# The default grid covers the BEHR domain
+default_grid = [-125.0, -65.0, 25.0, 50.0]
+default_resolution = 0.05
+
+seasons = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM',
+           6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+
+def parse_grid(value):
+    try:
+        grid = [float(x) for x in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('the grid must be four numbers')
+    if len(grid) != 4:
+        raise argparse.ArgumentTypeError('the grid must be four numbers: lon_min,lon_max,lat_min,lat_max')
+    elif grid[0] >= grid[1] or grid[2] >= grid[3]:
+        raise argparse.ArgumentTypeError('the grid minimums must be less than the maximums')
+    return grid
+
+def parse_resolution(value):
+    try:
+        res = [float(x) for x in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('the resolution must be one or two numbers')
+    if len(res) == 1:
+        res *= 2
+    if len(res) != 2 or res[0] <= 0 or res[1] <= 0:
+        raise argparse.ArgumentTypeError('the resolution must be one or two positive numbers: dlon[,dlat]')
+    return res
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Average BEHR pixels from many swaths and days onto a lat/lon grid, saved as HDF5')
+    parser.add_argument('file_in', type=str, help='the .hdf file(s) to grid', nargs='+')
+    parser.add_argument('--vars', type=str, action=CreateList, default=[], help='variable(s) to grid in addition to {0}'.format(no2_var))
+    parser.add_argument('--grid', type=parse_grid, default=default_grid, help='the edges of the grid, given as lon_min,lon_max,lat_min,lat_max. Default is the BEHR domain, {0}.'.format(','.join(str(x) for x in default_grid)))
+    parser.add_argument('--resolution', type=parse_resolution, default=[default_resolution]*2, help='the grid cell size in degrees, as dlon or dlon,dlat. Default is {0}.'.format(default_resolution))
+    parser.add_argument('--period', choices=['day', 'month', 'season', 'all'], default='month', help='average over each day, month, season (DJF, MAM, JJA, SON; December counts toward the next year\'s DJF), or all the files given. Default is month.')
+    parser.add_argument('--reject-flags', type=int, default=None, help='only grid pixels where none of these bits are set in the --flag-var variable, e.g. 1 to remove pixels BEHR flags as low quality.')
+    parser.add_argument('--flag-var', type=str, default='BEHRQualityFlags', help='the variable to check against --reject-flags, default is BEHRQualityFlags.')
+    parser.add_argument('--out-prefix', type=str, default='', help='the prefix for the output files, default is the same as the first input file followed by _gridded')
+
+    args = parser.parse_args()
+    args.vars = [no2_var] + [v for v in args.vars if v != no2_var]
+    return args
+
+def file_date(file_in_name):
+    match = re.search('\d\d\d\d\d\d\d\d', os.path.basename(file_in_name))
+    if match is None:
+        shell_error('Cannot find a yyyymmdd date in the file name {0}'.format(file_in_name))
+    return match.group()
+
+def period_key(datestr, period):
+    year, month = int(datestr[:4]), int(datestr[4:6])
+    if period == 'day':
+        return datestr
+    elif period == 'month':
+        return datestr[:6]
+    else:
+        if month == 12:
+            year += 1
+        return '{0:04d}{1}'.format(year, seasons[month])
+
+class GridAccumulator(object):
+    # Keeps a running sum and pixel count in each grid cell for each variable, so that any number of swaths can be
+    # added while memory use stays at a few arrays the size of the grid. The means are only computed when written.
+    def __init__(self, grid, resolution, vars):
+        self.lon_min, self.lon_max, self.lat_min, self.lat_max = grid
+        self.dlon, self.dlat = resolution
+        self.nlon = int(np.ceil(round((self.lon_max - self.lon_min) / self.dlon, 6)))
+        self.nlat = int(np.ceil(round((self.lat_max - self.lat_min) / self.dlat, 6)))
+        self.vars = vars
+        self.sums = dict((v, np.zeros(self.nlat * self.nlon)) for v in vars)
+        self.counts = dict((v, np.zeros(self.nlat * self.nlon, dtype=np.int64)) for v in vars)
+        self.files = []
+
+    def add_swath(self, swath, subset=None):
+        if subset is None:
+            shape = swath['Longitude'].shape
+            subset = (slice(0, shape[0]), slice(0, shape[1]), None)
+        rows, cols, mask = subset
+
+        # Work out which grid cell each pixel falls in once, then accumulate every variable into those cells with
+        # np.bincount, which adds up all the pixels in the same cell without a Python loop.
+        lon = swath['Longitude'][rows, cols]
+        lat = swath['Latitude'][rows, cols]
+        ix = np.floor((lon - self.lon_min) / self.dlon)
+        iy = np.floor((lat - self.lat_min) / self.dlat)
+        in_grid = (ix >= 0) & (ix < self.nlon) & (iy >= 0) & (iy < self.nlat)
+        if mask is not None:
+            in_grid &= mask
+        cell = (iy[in_grid] * self.nlon + ix[in_grid]).astype(np.int64)
+
+        for v in self.vars:
+            try:
+                dset = swath[v]
+            except KeyError:
+                shell_error('The variable {0} is not present in {1}'.format(v, swath.file.filename))
+            if dset.ndim != 2:
+                shell_error('Only 2D variables can be gridded, {0} has {1} dimensions'.format(v, dset.ndim))
+
+            vals = dset[rows, cols][in_grid].astype(np.float64)
+            good = np.isfinite(vals)
+            fill = dset.attrs.get('_FillValue')
+            if fill is not None:
+                good &= vals != np.asarray(fill).ravel()[0]
+            self.sums[v] += np.bincount(cell[good], weights=vals[good], minlength=self.sums[v].size)
+            self.counts[v] += np.bincount(cell[good], minlength=self.counts[v].size)
+
+    def write(self, filename, period):
+        with h5py.File(filename, 'w') as fout:
+            fout.attrs['Period'] = period
+            fout.attrs['GridResolution'] = [self.dlon, self.dlat]
+            fout.attrs['InputFiles'] = [os.path.basename(f) for f in self.files]
+            fout['Longitude'] = self.lon_min + self.dlon * (np.arange(self.nlon) + 0.5)
+            fout['Latitude'] = self.lat_min + self.dlat * (np.arange(self.nlat) + 0.5)
+            fout['Longitude'].attrs['Description'] = 'Longitude of the grid cell centers'
+            fout['Latitude'].attrs['Description'] = 'Latitude of the grid cell centers'
+            for v in self.vars:
+                counts = self.counts[v].reshape(self.nlat, self.nlon)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    means = np.where(counts > 0, self.sums[v].reshape(self.nlat, self.nlon) / counts, np.nan)
+                fout.create_dataset(v, data=means.astype(np.float32), compression='gzip', shuffle=True)
+                fout.create_dataset(v + 'Count', data=counts.astype(np.int32), compression='gzip', shuffle=True)
+                fout[v].attrs['Description'] = 'Mean of the pixels centered in each grid cell, NaN where there are none'
+                fout[v + 'Count'].attrs['Description'] = 'Number of pixels averaged in each grid cell for {0}'.format(v)
+
+def outfile_name(args, first_file_in_name, key):
+    if args.out_prefix == '':
+        basename = os.path.basename(first_file_in_name)
+        prefix = basename[:re.search('\d\d\d\d\d\d\d\d', basename).start()].rstrip('_') + '_gridded'
+    else:
+        prefix = args.out_prefix.rstrip('_')
+    return '{0}_{1}.hdf'.format(prefix, key)
+
+def grid_files(args):
+    # Files are sorted by date so that each averaging period is a contiguous run of files; only one period's
+    # accumulator is held at a time and it is written out as soon as the next period starts.
+    files_in = sorted(args.file_in, key=file_date)
+    first_date, last_date = file_date(files_in[0]), file_date(files_in[-1])
+    all_key = first_date if first_date == last_date else first_date + '-' + last_date
+    acc = None
+    key = None
+    written = []
+
+    def flush():
+        filename = outfile_name(args, acc.files[0], key)
+        acc.write(filename, key)
+        written.append(filename)
+
+    for f in files_in:
+        this_key = all_key if args.period == 'all' else period_key(file_date(f), args.period)
+        if acc is not None and this_key != key:
+            flush()
+            acc = None
+        if acc is None:
+            acc = GridAccumulator(args.grid, args.resolution, args.vars)
+            key = this_key
+
+        h5f = h5py.File(f, 'r')
+        try:
+            for swath in h5f['Data']:
+                subset = swath_subset(h5f['Data'][swath], bbox=args.grid, reject_flags=args.reject_flags, flag_var=args.flag_var)
+                if subset is not None:
+                    acc.add_swath(h5f['Data'][swath], subset=subset)
+        finally:
+            h5f.close()
+        acc.files.append(f)
+
+    if acc is not None:
+        flush()
+    return written
+
+def main():
+    args = get_args()
+    for filename in grid_files(args):
+        print('Wrote {0}'.format(filename))
+
+
+if __name__ == "__main__":
+    main()
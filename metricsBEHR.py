@@ -0,0 +1,41 @@
+from __future__ import print_function
+from __future__ import division
+from __future__ import absolute_import
+
+import glob
+import os
+import pstats
+import sys
+import time
+
+# The phase timing is shared with BEHRDownloader, whose package sits in this repository but need not be installed.
+# Appended rather than put first so that nothing in BEHRDownloader can shadow the modules here. That module has to
+# stay Python 2 compatible for these scripts; BEHRDownloader/tests/test_metrics.py checks it.
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'BEHRDownloader'))
+from behrdownloader.metrics import PhaseMetrics, add, collecting, get_metrics, peak_memory_mb, phase, profiled
+
+def worker_profile_prefix(filename):
+    # The start of the names worker processes save their statistics under. It includes the id of the main process,
+    # so that statistics left behind by an earlier run that crashed are not merged into this one's.
+    if filename is None:
+        return None
+    return '{0}.part{1}'.format(filename, os.getpid())
+
+def worker_profile_name(prefix):
+    # cProfile only sees the process it runs in, so each task run in a worker process saves its own statistics under
+    # this name, to be combined by merge_worker_profiles afterwards. prefix comes from worker_profile_prefix, called
+    # in the main process.
+    if prefix is None:
+        return None
+    return '{0}-{1}-{2}'.format(prefix, os.getpid(), int(time.time() * 1e6))
+
+def merge_worker_profiles(filename):
+    # Add the statistics saved by this run's worker processes to those in filename, then remove them
+    parts = sorted(glob.glob(worker_profile_prefix(filename) + '-*'))
+    if len(parts) == 0:
+        return
+    sources = ([filename] if os.path.isfile(filename) else []) + parts
+    stats = pstats.Stats(*sources)
+    stats.dump_stats(filename)
+    for p in parts:
+        os.remove(p)
@@ -3,16 +3,55 @@ from __future__ import division
 from __future__ import absolute_import
 from __builtin__ import int
 
+import argparse
 import h5py
+import multiprocessing
 import os
+import random
 import re
 import sys
+import time
 import pdb
 
+from catalogBEHR import SwathCatalog, bbox_overlaps, parse_bbox, swath_bbox
+import metricsBEHR
+
+valid_compression = ('gzip', 'lzf')
+
 def print_usage():
-    print("Usage: python {0} <files>".format(sys.argv[0]))
+    print("Usage: python {0} [--workers N] [--link | --virtual] [--chunk-rows N] [--compression gzip|lzf]".format(sys.argv[0]))
+    print("       [--compression-level N] [--shuffle] [--report] [--bbox W,E,S,N [--catalog FILE]]")
+    print("       [--metrics-out FILE] [--profile FILE] <files>")
     print("    Splits OMI_BEHR .hdf (version 5) files into individual swaths")
     print("    Pass the files to split as arguments to this program.")
+    print("    Options (must come before the files):")
+    print("      --workers N   split N files at once in separate processes.")
+    print("      --link        instead of copying the swath data, write small files")
+    print("                    with HDF5 external links to the data in the original")
+    print("                    file. The original file must be kept alongside them.")
+    print("      --virtual     like --link, but using HDF5 virtual datasets, which")
+    print("                    more programs can read (requires HDF5 1.10 or later).")
+    print("      --chunk-rows N     store each swath dataset in chunks of N along-track")
+    print("                         rows (the full width of the other dimensions). Small")
+    print("                         chunks make reading a few rows at a time faster.")
+    print("      --compression C    compress each swath dataset with C, either gzip")
+    print("                         (smaller) or lzf (faster).")
+    print("      --compression-level N  the gzip level, 0 to 9 (default 4).")
+    print("      --shuffle          apply the HDF5 shuffle filter before compressing,")
+    print("                         which usually makes floating point data compress better.")
+    print("      --report           print the size and time to read random rows of each")
+    print("                         swath in the original and new file.")
+    print("      --bbox W,E,S,N     only write swaths with pixels inside this box, given as")
+    print("                         lon_min,lon_max,lat_min,lat_max.")
+    print("      --catalog FILE     a swath catalog made by catalogBEHR.py. With --bbox,")
+    print("                         files the catalog shows have no swaths in the box are")
+    print("                         skipped without opening them.")
+    print("      --metrics-out FILE write the time spent and data handled in each phase")
+    print("                         (reading, writing, copying) to this JSON file.")
+    print("      --profile FILE     run under cProfile and save the statistics to FILE,")
+    print("                         for python -m pstats. With --workers, the workers'")
+    print("                         statistics are included.")
+    print("    --chunk-rows, --compression and --shuffle cannot be used with --link or --virtual.")
     print("    Examples:")
     print("        python {0} OMI_BEHR_v2-1B_20150601.hdf")
     print("        (this will split the file OMI_BEHR_v2-1B_20150601.hdf into")
@@ -21,6 +60,16 @@ def print_usage():
     print("        python {0} OMI_BEHR_v2-1B_201506*")
     print("        (this will split all files from June.")
     print("")
+    print("        python {0} --workers 4 OMI_BEHR_v2-1B_2015*")
+    print("        (this will split all files from 2015, four at a time.")
+    print("")
+    print("        python {0} --virtual OMI_BEHR_v2-1B_2015*")
+    print("        (this will split all files from 2015 without copying the data.")
+    print("")
+    print("        python {0} --chunk-rows 100 --compression gzip --shuffle --report OMI_BEHR_v2-1B_201506*")
+    print("        (this will split all files from June into compressed files chunked")
+    print("         100 rows at a time, and report how the size and read speed changed.")
+    print("")
     print("    Output files are saved to the same directory as the input files.")
     print("    Files to split must begin with OMI_BEHR and end in .hdf.")
     exit(0)
@@ -29,9 +78,65 @@ def parse_args(args):
     if len(args) < 2 or '-h' in args or '--help' in args:
         print_usage()
 
+    args = args[1:]
+    options = {'workers': 1, 'mode': 'copy', 'chunk_rows': None, 'compression': None, 'compression_level': None,
+               'shuffle': False, 'report': False, 'bbox': None, 'catalog': None, 'metrics_out': None, 'profile': None}
+    while len(args) > 0 and args[0].startswith('--'):
+        opt, _, value = args.pop(0).partition('=')
+        if opt in ('--workers', '--chunk-rows', '--compression-level'):
+            key = opt[2:].replace('-', '_')
+            try:
+                options[key] = int(value if value else args.pop(0))
+            except (ValueError, IndexError):
+                print('{0} must be followed by a number'.format(opt), file=sys.stderr)
+                exit(1)
+            if key == 'compression_level' and not 0 <= options[key] <= 9:
+                print('--compression-level must be between 0 and 9', file=sys.stderr)
+                exit(1)
+            elif key != 'compression_level' and options[key] < 1:
+                print('{0} must be at least 1'.format(opt), file=sys.stderr)
+                exit(1)
+        elif opt == '--compression':
+            options['compression'] = value if value else (args.pop(0) if len(args) > 0 else '')
+            if options['compression'] not in valid_compression:
+                print('--compression must be one of {0}'.format(', '.join(valid_compression)), file=sys.stderr)
+                exit(1)
+        elif opt == '--bbox':
+            if not value and len(args) == 0:
+                print('--bbox must be followed by lon_min,lon_max,lat_min,lat_max', file=sys.stderr)
+                exit(1)
+            try:
+                options['bbox'] = parse_bbox(value if value else args.pop(0))
+            except argparse.ArgumentTypeError as err:
+                print('--bbox: {0}'.format(err), file=sys.stderr)
+                exit(1)
+        elif opt in ('--catalog', '--metrics-out', '--profile'):
+            if not value and len(args) == 0:
+                print('{0} must be followed by a file name'.format(opt), file=sys.stderr)
+                exit(1)
+            options[opt[2:].replace('-', '_')] = value if value else args.pop(0)
+        elif opt in ('--shuffle', '--report'):
+            options[opt[2:]] = True
+        elif opt in ('--link', '--virtual'):
+            if options['mode'] != 'copy':
+                print('--link and --virtual are mutually exclusive', file=sys.stderr)
+                exit(1)
+            options['mode'] = opt[2:]
+        else:
+            print('Unknown option {0}'.format(opt), file=sys.stderr)
+            exit(1)
+
+    if options['compression_level'] is not None and options['compression'] != 'gzip':
+        print('--compression-level only applies to --compression gzip', file=sys.stderr)
+        exit(1)
+    if options['mode'] != 'copy' and (options['chunk_rows'] is not None or options['compression'] is not None or
+                                      options['shuffle']):
+        print('--chunk-rows, --compression and --shuffle cannot be used with --link or --virtual', file=sys.stderr)
+        exit(1)
+
     savedirs = []
     files = []
-    for fname in args[1:]:
+    for fname in args:
         path = os.path.dirname(fname)
         if len(path) == 0:
             path = '.'
@@ -43,27 +148,208 @@ def parse_args(args):
             exit(1)
         files.append(filename)
 
-    return savedirs, files
+    return savedirs, files, options
+
+
+def link_swath(f, filename, swath, data_group, virtual=False):
+    # Recreate the swath group, but with each dataset pointing at the data in the original file rather than holding
+    # a copy of it. The original file is referred to by its name alone, which HDF5 looks for in the same directory
+    # as the file containing the links.
+    src = f['Data'][swath]
+    g = data_group.create_group(swath)
+    for k, v in src.attrs.items():
+        g.attrs[k] = v
+
+    for name, dset in src.items():
+        target = '/Data/{0}/{1}'.format(swath, name)
+        if virtual and isinstance(dset, h5py.Dataset):
+            layout = h5py.VirtualLayout(shape=dset.shape, dtype=dset.dtype)
+            layout[...] = h5py.VirtualSource(filename, target, shape=dset.shape)
+            vds = g.create_virtual_dataset(name, layout, fillvalue=dset.fillvalue)
+            for k, v in dset.attrs.items():
+                vds.attrs[k] = v
+        else:
+            g[name] = h5py.ExternalLink(filename, target)
+
+
+def write_swath(f, swath, data_group, chunk_rows=None, compression=None, compression_level=None, shuffle=False):
+    # Rewrite each dataset of the swath with the requested storage layout rather than copying it as is. Datasets are
+    # chunked along the first (along-track) dimension only, so that reading a few rows touches as few chunks as
+    # possible. If only compression or shuffle is requested, h5py picks the chunk shape.
+    src = f['Data'][swath]
+    g = data_group.create_group(swath)
+    for k, v in src.attrs.items():
+        g.attrs[k] = v
+
+    for name, dset in src.items():
+        if not isinstance(dset, h5py.Dataset) or dset.shape is None or len(dset.shape) == 0 or dset.size == 0:
+            # Scalar and empty datasets cannot be chunked, and anything that is not a dataset is copied unchanged
+            f.copy(dset, g, expand_external=True, expand_soft=True, expand_refs=True)
+            continue
+
+        if chunk_rows is not None:
+            chunks = (min(chunk_rows, dset.shape[0]),) + dset.shape[1:]
+        elif compression is not None or shuffle:
+            chunks = True
+        else:
+            chunks = dset.chunks
+
+        with metricsBEHR.phase('read', bytes=dataset_bytes(dset)):
+            data = dset[()]
+        with metricsBEHR.phase('write', bytes=dataset_bytes(dset)):
+            new = g.create_dataset(name, data=data, chunks=chunks, compression=compression,
+                                   compression_opts=compression_level if compression == 'gzip' else None,
+                                   shuffle=shuffle, fillvalue=dset.fillvalue)
+        for k, v in dset.attrs.items():
+            new.attrs[k] = v
+
 
+def dataset_bytes(dset):
+    # The uncompressed size of a dataset's values
+    return dset.size * dset.dtype.itemsize
+
+
+def swath_storage_size(group):
+    # The bytes allocated in the file for the datasets in a swath, which for a compressed dataset is its compressed size
+    return sum(d.id.get_storage_size() for d in group.values() if isinstance(d, h5py.Dataset))
+
+
+def time_row_reads(group, rows):
+    # Time reading the given along-track rows of every dataset in a swath one at a time, the way code that walks
+    # through a swath pixel by pixel would. Each dataset is read once untimed first so that the page cache is warm
+    # for both the original and new file, otherwise whichever file was read first would look slower.
+    dsets = [d for d in group.values() if isinstance(d, h5py.Dataset) and len(d.shape) > 0 and d.shape[0] > 0]
+    for d in dsets:
+        d[()]
+    t0 = time.time()
+    for d in dsets:
+        for r in rows:
+            d[r % d.shape[0]]
+    return time.time() - t0
+
+
+def report_swath(f, swath, newfile, n_reads=200):
+    src = f['Data'][swath]
+    nrows = max([d.shape[0] for d in src.values() if isinstance(d, h5py.Dataset) and len(d.shape) > 0] + [1])
+    rows = random.Random(0).sample(range(nrows), min(n_reads, nrows))
+    old_size = swath_storage_size(src)
+    old_time = time_row_reads(src, rows)
+    with h5py.File(newfile, 'r') as fnew:
+        new_group = fnew['Data'][swath]
+        new_size = swath_storage_size(new_group)
+        new_time = time_row_reads(new_group, rows)
+    print('{0} {1}: data {2:.2f} MB -> {3:.2f} MB ({4:.2f} MB on disk), {5} random row reads {6:.3f} s -> {7:.3f} s'.format(
+        os.path.basename(newfile), swath, old_size / 1e6, new_size / 1e6, os.path.getsize(newfile) / 1e6, len(rows),
+        old_time, new_time))
+
+
+def split_swaths(filepath, filename, mode='copy', chunk_rows=None, compression=None, compression_level=None,
+                 shuffle=False, report=False, bbox=None, swaths=None):
+    if swaths is not None and len(swaths) == 0:
+        # The catalog shows nothing in this file is wanted, so don't open it
+        return
 
-def split_swaths(filepath, filename):
     f = h5py.File(os.path.join(filepath, filename), 'r')
     ext_ind = filename.rfind('.')
     basename = filename[:ext_ind]
     if filename[ext_ind:] != '.hdf':
         raise RuntimeError('{0} does not end in .hdf. Are you sure it is a BEHR HDFv5 file?'.format(filename))
-    swaths = f['Data'].keys()
+    # Without a list of swaths from the catalog, each swath's latitude and longitude have to be read to check whether
+    # it overlaps the bounding box.
+    if swaths is None:
+        with metricsBEHR.phase('bbox'):
+            swaths = [s for s in f['Data'] if bbox is None or bbox_overlaps(swath_bbox(f['Data'][s]), bbox)]
     for swath in swaths:
         newfile = "{0}-{1}.hdf".format(basename, swath)
-        fnew = h5py.File(os.path.join(filepath, newfile))
-        g=fnew.create_group('/Data')
-        f.copy('/Data/{0}'.format(swath), g, expand_external=True, expand_soft=True, expand_refs=True)
-        fnew.close()
+        src = f['Data'][swath]
+        n_pixels = src['Longitude'].size if 'Longitude' in src else 0
+        with metricsBEHR.phase('output', files=1, pixels=n_pixels) as counts:
+            fnew = h5py.File(os.path.join(filepath, newfile), 'w')
+            g=fnew.create_group('/Data')
+            if mode == 'copy' and (chunk_rows is not None or compression is not None or shuffle):
+                write_swath(f, swath, g, chunk_rows=chunk_rows, compression=compression,
+                            compression_level=compression_level, shuffle=shuffle)
+            elif mode == 'copy':
+                with metricsBEHR.phase('copy', bytes=sum(dataset_bytes(d) for d in src.values() if isinstance(d, h5py.Dataset))):
+                    f.copy('/Data/{0}'.format(swath), g, expand_external=True, expand_soft=True, expand_refs=True)
+            elif mode in ('link', 'virtual'):
+                with metricsBEHR.phase('link'):
+                    link_swath(f, filename, swath, g, virtual=(mode == 'virtual'))
+            else:
+                raise ValueError('mode must be one of "copy", "link", or "virtual"')
+            fnew.close()
+            counts['bytes'] = os.path.getsize(os.path.join(filepath, newfile))
+        if report:
+            with metricsBEHR.phase('report'):
+                report_swath(f, swath, os.path.join(filepath, newfile))
 
     f.close()
 
 
+def split_task(task):
+    # Catch any error so that one bad file is reported instead of stopping the rest of the batch. The metrics for the
+    # file are returned with the result so that the main process can add them up; a worker process's statistics are
+    # saved for the main process to merge if profiling.
+    filepath, filename, split_options, swaths, profile = task
+    infile = os.path.join(filepath, filename)
+    err = None
+    with metricsBEHR.collecting() as metrics, metricsBEHR.profiled(metricsBEHR.worker_profile_name(profile)):
+        t0 = time.time()
+        try:
+            split_swaths(filepath, filename, swaths=swaths, **split_options)
+        except Exception as e:
+            err = '{0}: {1}'.format(type(e).__name__, e)
+        else:
+            metricsBEHR.add('file', time.time() - t0, files=1, bytes=os.path.getsize(infile))
+    return infile, err, metrics.as_dict()
+
+
+def print_summary(results):
+    failures = [(f, err) for f, err in results if err is not None]
+    print('{0} of {1} files split successfully'.format(len(results) - len(failures), len(results)))
+    for f, err in failures:
+        print('  FAILED {0}: {1}'.format(f, err), file=sys.stderr)
+    return len(failures)
+
+
+def run(savedirs, origfiles, options):
+    # Returns the number of files that could not be split
+    split_options = dict((k, v) for k, v in options.items() if k not in ('workers', 'catalog', 'metrics_out', 'profile'))
+    if options['catalog'] is not None and options['bbox'] is not None:
+        with metricsBEHR.phase('catalog'):
+            catalog = SwathCatalog(options['catalog'])
+            file_swaths = [catalog.swaths_overlapping(os.path.join(d, f), options['bbox']) for d, f in zip(savedirs, origfiles)]
+    else:
+        file_swaths = [None] * len(origfiles)
+    # Files split in this process are already covered by the main profile
+    worker_profile = metricsBEHR.worker_profile_prefix(options['profile']) if options['workers'] > 1 else None
+    tasks = [(d, f, split_options, s, worker_profile) for d, f, s in zip(savedirs, origfiles, file_swaths)]
+    if options['workers'] > 1:
+        pool = multiprocessing.Pool(options['workers'])
+        try:
+            results = pool.map(split_task, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [split_task(t) for t in tasks]
+
+    for f, err, phases in results:
+        metricsBEHR.get_metrics().merge(phases)
+    return print_summary([(f, err) for f, err, phases in results])
+
+
 if __name__ == "__main__":
-    savedirs, origfiles = parse_args(sys.argv)
-    for i in range(len(savedirs)):
-        split_swaths(savedirs[i], origfiles[i])
+    savedirs, origfiles, options = parse_args(sys.argv)
+    t0 = time.time()
+    with metricsBEHR.collecting() as metrics:
+        with metricsBEHR.profiled(options['profile']):
+            n_failed = run(savedirs, origfiles, options)
+
+    if options['profile'] is not None:
+        metricsBEHR.merge_worker_profiles(options['profile'])
+    if options['metrics_out'] is not None:
+        metrics.write(options['metrics_out'], time.time() - t0, files_in=len(origfiles), failed=n_failed,
+                      mode=options['mode'], workers=options['workers'])
+    if n_failed > 0:
+        exit(1)